@@ -28,8 +28,11 @@ APPDIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 
 pushd $APPDIR/../src
 
-7z e -so ${DATADIR}cleantext/$1.cleantext.json.7z | LC_ALL=C tr -dc '\0-\177' | python generate-embeddings.py \
---input - \
+# the archive is decompressed by generate-embeddings.py itself (7z -mmt), which also drops non-ASCII bytes;
+# the input stays addressable by offset, so --resume skips the consumed part without parsing it
+python generate-embeddings.py \
+--input ${DATADIR}cleantext/$1.cleantext.json.7z \
+--ascii_only \
 --input_format tsv \
 --is_json \
 --model t5-base \
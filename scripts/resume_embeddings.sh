@@ -4,8 +4,9 @@
 # 1 input name
 # 2 encoding batch size
 # 3 num worker threads
-# 4 lastdoc = the last document previously seen; processing will start after this doc
-# 5 filepostfix = the starting segment number (postfix) of the output files for this run
+#
+# the restart position (input offset, last document, output file postfix) is read from
+# ${OUTDIR}$1.manifest.jsonl, written by the previous run each time it closed an output shard
 #
 #
 #
@@ -17,7 +18,7 @@
 
 APPDIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 
-$APPDIR/get_embeddings.sh $1 $2 $3 --lastdoc=$4 --filepostfix=$5
+$APPDIR/get_embeddings.sh $1 $2 $3 --resume
 
 #7z e -so cleantext/$1.cleantext.json.7z | LC_ALL=C tr -dc '\0-\177' | python $APPDIR/../src/generate-embeddings.py \
 #--input - \
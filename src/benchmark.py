@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import json
+import random
+import argparse
+import tempfile
+import itertools
+import importlib.util
+from time import perf_counter
+
+import numpy as np
+
+
+# deterministic synthetic segments: word counts uniform in [min_words, max_words]
+def synthetic_segments(n, min_words=20, max_words=450, seed=0):
+    rng = random.Random(seed)
+    vocab = ["w{}".format(i) for i in range(5000)]
+    return [" ".join(rng.choices(vocab, k=rng.randint(min_words, max_words))) for _ in range(n)]
+
+
+# synthetic document groups covering n segments (1-4 segments per document)
+def synthetic_groups(n, seed=0):
+    rng = random.Random(seed)
+    groups = []
+    left = n
+    while left > 0:
+        g = min(rng.randint(1, 4), left)
+        groups.append(g)
+        left -= g
+    return groups
+
+
+# deterministic synthetic corpus lines: docid \t url \t {"body": ...}
+#   body lengths are log-normal (median ~400 words, long tail), with punctuation, newlines and some non-ascii
+def synthetic_lines(n, seed=0):
+    rng = random.Random(seed)
+    vocab = ["w{}".format(i) for i in range(5000)] + ["the", "a", "of", "and", "caf\u00e9", "--", "|", "/"]
+    lines = []
+    for i in range(n):
+        words = min(20000, max(5, int(rng.lognormvariate(6.0, 1.0))))
+        body = " ".join(rng.choice(vocab) + rng.choice(["", "", "", ",", ".", "\n", "  "]) for _ in range(words))
+        lines.append("doc{}\thttp://example.com/{}\t{}\n".format(i, i, json.dumps({"body": body})))
+    return lines
+
+
+# the previous cleaning path: json + two regex passes + findall/join chunking
+def legacy_clean_lines(lines, max_words):
+    remove_chars = re.compile(r'[\n\|/\x00-\x09\x0c-\x1f\x80-\xff]')
+    multiple_spaces = re.compile(r'  +')
+    words = re.compile(r'\w+')
+    segments = []
+    for line in lines:
+        docid, url, content = line.split("\t")
+        body = multiple_spaces.sub(' ', remove_chars.sub(' ', json.loads(content)["body"]))
+        tokens = words.findall(body)
+        if len(tokens) <= max_words:
+            segments.append(body)
+            continue
+        for start in range(0, len(tokens), max_words):
+            segments.append(" ".join(tokens[start:start + max_words - 1]))
+    return segments
+
+
+# cleaning throughput (lines/sec) of cleantext.clean_lines on a synthetic corpus
+def bench_clean(args):
+    from tiering.cleantext import clean_lines, json_loads
+    lines = synthetic_lines(args.lines)
+    print("parser: {}".format(json_loads.__module__))
+    print("impl\tlines\tsegments\tseconds\tlines/sec")
+    impls = [("batch", lambda chunk: clean_lines(chunk, args.max_words)[1])]
+    if args.compare:
+        impls.append(("legacy", lambda chunk: legacy_clean_lines(chunk, args.max_words)))
+    for name, fn in impls:
+        segments = 0
+        t0 = perf_counter()
+        for start in range(0, len(lines), args.chunk_lines):
+            segments += len(fn(lines[start:start + args.chunk_lines]))
+        t = perf_counter() - t0
+        print("%s\t%d\t%d\t%0.3f\t%0.1f" % (name, len(lines), segments, t, len(lines) / t))
+
+
+# deterministic clustered vectors, a stand-in for real embeddings when no shard is given
+def synthetic_vectors(n, dim=768, clusters=50, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    return centers[rng.integers(0, clusters, n)] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+
+
+# recall@k of each storage codec against the float32 vectors, to choose a size/quality tradeoff
+def bench_quantization(args):
+    from tiering.quantize import make_codec, recall_at_k
+    if args.shard:
+        from tiering.shards import ShardReader
+        vectors = np.asarray(ShardReader(args.shard)[:args.rows], dtype=np.float32)
+    else:
+        vectors = synthetic_vectors(args.rows)
+    queries = np.random.default_rng(1).choice(len(vectors), min(args.queries, len(vectors)), replace=False)
+    print("codec\tbytes/vector\trecall@%d" % args.k)
+    for name in args.codecs:
+        codec = make_codec(name, args.pq_m)
+        codec.fit(vectors[:args.sample])
+        codes = codec.encode(vectors)
+        recall = recall_at_k(vectors, codec.decode(codes), queries, args.k)
+        print("%s\t%d\t%0.4f" % (name, codes.nbytes // len(codes), recall))
+
+
+# QPS of exact and IVF search over shards, and IVF recall@k vs. the exact results
+def bench_search(args):
+    from tiering.shards import ShardWriter
+    from tiering.search import ShardSet, ExactSearch, IVFIndex, recall
+    tmp = tempfile.mkdtemp()
+    names = args.shards
+    if not names:
+        names = [os.path.join(tmp, "synthetic")]
+        writer = ShardWriter(names[0])
+        vectors = synthetic_vectors(args.rows, clusters=args.nlist)
+        writer.append(["doc{}".format(i) for i in range(len(vectors))], vectors)
+        writer.close()
+    shards = ShardSet(names)
+    rng = np.random.default_rng(1)
+    picks = np.sort(rng.choice(shards.rows, min(args.queries, shards.rows), replace=False))
+    # perturbed copies of sampled rows, so the queries are near but not on the indexed vectors
+    queries = shards.take(picks)
+    queries += 0.1 * rng.normal(size=queries.shape).astype(np.float32)
+
+    t0 = perf_counter()
+    index = IVFIndex.build(args.index or os.path.join(tmp, "ivf"), shards, args.nlist, args.metric, args.sample)
+    print("ivf build: %d rows, %d lists, %0.3f s" % (shards.rows, len(index.centroids), perf_counter() - t0))
+    print("search\tnprobe\tqueries\tseconds\tqps\trecall@%d" % args.k)
+    t0 = perf_counter()
+    exact = ExactSearch(shards, args.metric).search(queries, args.k)[1]
+    t = perf_counter() - t0
+    print("exact\t-\t%d\t%0.3f\t%0.1f\t1.0000" % (len(queries), t, len(queries) / t))
+    for nprobe in args.nprobe:
+        t0 = perf_counter()
+        approx = index.search(queries, args.k, nprobe)[1]
+        t = perf_counter() - t0
+        print("ivf\t%d\t%d\t%0.3f\t%0.1f\t%0.4f" % (nprobe, len(queries), t, len(queries) / t, recall(exact, approx)))
+        sys.stdout.flush()
+
+
+# the previous T5Processor.get_embeddings: tf.concat per mini-batch + a python loop per document
+def concat_get_embeddings(t5, documents, groupings):
+    import tensorflow as tf
+    s = len(documents)
+    start = 0
+    end = t5.batch_size
+    embeddings = None
+    while start < s:
+        t5.fit(documents[start:end], split=False).paragraph_embeddings()
+        if embeddings is None:
+            embeddings = t5.embeddings['paragraphs']
+        else:
+            embeddings = tf.concat([embeddings, t5.embeddings['paragraphs']], axis=0)
+        start += t5.batch_size
+        end += t5.batch_size
+    tensor_list = tf.split(embeddings, groupings)
+    results = np.zeros(shape=[len(groupings), t5.dim], dtype=np.float32)
+    for idx, t in enumerate(tensor_list):
+        results[idx] = tf.reduce_mean(t, axis=0).numpy()
+    return results
+
+
+# per-segment-batch latency of T5Processor.get_embeddings as segment_batch_size grows
+def bench_segment_batch(args):
+    from tiering.T5Processor import T5Processor
+    t5 = T5Processor(args.model, batch_size=args.encode_batch_size)
+    # warm up the graph before timing
+    t5.get_embeddings(synthetic_segments(args.encode_batch_size, max_words=args.max_words), None)
+    print("segment_batch_size\timpl\tseconds\tms/segment")
+    for size in args.sizes:
+        documents = synthetic_segments(size, max_words=args.max_words, seed=size)
+        groups = synthetic_groups(size, seed=size)
+        impls = [("buffer", t5.get_embeddings)]
+        if args.compare:
+            impls.append(("concat", lambda d, g: concat_get_embeddings(t5, d, g)))
+        for name, fn in impls:
+            t0 = perf_counter()
+            fn(documents, groups)
+            t = perf_counter() - t0
+            print("%d\t%s\t%0.3f\t%0.3f" % (size, name, t, 1000 * t / size))
+            sys.stdout.flush()
+
+
+# synthetic_lines written to <directory>/corpus.<input_format>, plus the bare bodies (tokenizer training text)
+def synthetic_corpus(directory, lines, input_format="tsv", seed=0):
+    path = os.path.join(directory, "corpus." + input_format)
+    rows = synthetic_lines(lines, seed=seed)
+    with open(path, "w", encoding="utf8") as f, open(path + ".txt", "w", encoding="utf8") as text:
+        for row in rows:
+            fields = row.split("\t", 2)
+            f.write(row if input_format == "tsv" else ",".join(fields))
+            text.write(json.loads(fields[2])["body"].replace("\n", " ") + "\n")
+    return path
+
+
+# a tiny randomly-initialized T5 saved under path, with a sentencepiece vocabulary trained on text_file;
+# loads offline with T5Processor(path) and AutoTokenizer (--segment_tokens)
+def tiny_t5(path, text_file, d_model=64, vocab_size=2000):
+    import sentencepiece as spm
+    import tensorflow as tf
+    from transformers import T5Config, T5Tokenizer, TFT5ForConditionalGeneration
+    os.makedirs(path, exist_ok=True)
+    # T5 ids: pad 0, eos 1, unk 2, no bos
+    spm.SentencePieceTrainer.train(input=text_file, model_prefix=os.path.join(path, "spiece"), vocab_size=vocab_size,
+                                   pad_id=0, eos_id=1, unk_id=2, bos_id=-1, input_sentence_size=20000,
+                                   shuffle_input_sentence=True, minloglevel=2)
+    tokenizer = T5Tokenizer(os.path.join(path, "spiece.model"))
+    tokenizer.save_pretrained(path)
+    tf.random.set_seed(0)
+    config = T5Config(vocab_size=len(tokenizer), d_model=d_model, d_kv=d_model // 4, d_ff=4 * d_model,
+                      num_layers=2, num_decoder_layers=1, num_heads=4, decoder_start_token_id=0)
+    model = TFT5ForConditionalGeneration(config)
+    model(model.dummy_inputs)
+    model.save_pretrained(path)
+    return path
+
+
+# a tiny randomly-initialized BERT sentence model (mean pooling) saved under path, with a word-level
+# vocabulary covering synthetic_lines; loads offline with Sentence2Vec(path)
+def tiny_sentence_model(path, dim=64):
+    import torch
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+    from sentence_transformers import SentenceTransformer, models
+    bert = os.path.join(path, "bert")
+    os.makedirs(bert, exist_ok=True)
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "the", "a", "of", "and", "cafe", "-", ",", "."]
+    with open(os.path.join(bert, "vocab.txt"), "w", encoding="utf8") as f:
+        f.write("\n".join(vocab + ["w{}".format(i) for i in range(5000)]) + "\n")
+    tokenizer = BertTokenizerFast(os.path.join(bert, "vocab.txt"))
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(tokenizer), hidden_size=dim, num_hidden_layers=2, num_attention_heads=4,
+                        intermediate_size=4 * dim, max_position_embeddings=512)
+    BertModel(config).save_pretrained(bert)
+    tokenizer.save_pretrained(bert)
+    word = models.Transformer(bert, max_seq_length=256)
+    SentenceTransformer(modules=[word, models.Pooling(word.get_word_embedding_dimension())]).save(path)
+    return path
+
+
+# the argument parser of generate-embeddings.py (its run is guarded by __main__, so loading it only builds it)
+def generate_embeddings_parser():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate-embeddings.py")
+    spec = importlib.util.spec_from_file_location("generate_embeddings", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.parser
+
+
+# end-to-end throughput (Cleantext -> DocumentProcessor -> vectorizer -> shard writers) on a synthetic corpus
+# with a tiny random model, over the product of encode_batch_size x num_workers x segment_batch_size;
+# one row per setting in a tab-separated results table
+def bench_pipeline(args):
+    from tiering.embeddings import Embeddings
+    work = args.workdir or tempfile.mkdtemp()
+    os.makedirs(work, exist_ok=True)
+    corpus = synthetic_corpus(work, args.lines, args.input_format)
+    model = args.model
+    if model is None:
+        model = os.path.join(work, "tiny-t5" if args.t5 else "tiny-sentence")
+        if args.t5 and not os.path.exists(os.path.join(model, "config.json")):
+            tiny_t5(model, corpus + ".txt")
+        elif not args.t5 and not os.path.exists(os.path.join(model, "modules.json")):
+            tiny_sentence_model(model)
+    generate = generate_embeddings_parser()
+    extra = args.extra[1:] if args.extra[:1] == ["--"] else args.extra
+
+    columns = ["encode_batch_size", "num_workers", "segment_batch_size", "lines", "segments", "seconds",
+               "lines/sec", "segments/sec", "tokens/sec", "padding", "clean_s", "encode_s", "write_s"]
+    results = open(args.results, "w") if args.results else None
+    for f in filter(None, [sys.stdout, results]):
+        f.write("\t".join(columns) + "\n")
+    for run, (encode_batch, workers, segment_batch) in enumerate(
+            itertools.product(args.encode_batch_size, args.num_workers, args.segment_batch_size)):
+        metrics = os.path.join(work, "metrics.{}.jsonl".format(run))
+        if os.path.exists(metrics):
+            os.remove(metrics)
+        options = ["-m", model, "-s", str(args.max_words), "--input", corpus, "--input_format", args.input_format,
+                   "--is_json", "-e", "-c", "-o", os.path.join(work, "out.{}".format(run)),
+                   "--device", "cpu", "--encode_batch_size", str(encode_batch), "--num_workers", str(workers),
+                   "-b", str(segment_batch), "--metrics", metrics, "--metrics_interval", "1e9"]
+        if args.t5:
+            options.append("--t5")
+        embeddings = Embeddings(generate.parse_args(options + extra))
+        t0 = perf_counter()
+        embeddings.run()
+        t = perf_counter() - t0
+        with open(metrics, "r") as f:
+            summary = json.loads(f.readlines()[-1])
+        seconds = summary['seconds']
+        counts = summary['counts']
+        row = [encode_batch, workers, segment_batch, counts['lines'], counts['segments'], "%0.3f" % t,
+               "%0.1f" % (counts['lines'] / t), "%0.1f" % (counts['segments'] / t), "%0.1f" % (counts['tokens'] / t),
+               "-" if summary['padding'] is None else "%0.3f" % summary['padding'],
+               "%0.3f" % (seconds['parse'] + seconds['clean'] + seconds['split']),
+               "%0.3f" % (seconds['tokenize'] + seconds['encode'] + seconds['pool']), "%0.3f" % seconds['write']]
+        for f in filter(None, [sys.stdout, results]):
+            f.write("\t".join(str(value) for value in row) + "\n")
+            f.flush()
+    if results:
+        results.close()
+
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+p = subparsers.add_parser("segment-batch", help="T5Processor.get_embeddings latency vs segment_batch_size")
+p.add_argument("-m", "--model", type=str, default="t5-small")
+p.add_argument("--encode_batch_size", type=int, default=32)
+p.add_argument("--max_words", type=int, default=100)
+p.add_argument("--sizes", type=int, nargs="+", default=[256, 512, 1024, 2048, 4096])
+p.add_argument("--compare", action="store_true", help="Also time the previous tf.concat implementation")
+p.set_defaults(func=bench_segment_batch)
+
+p = subparsers.add_parser("clean", help="Cleaning/splitting throughput in lines/sec")
+p.add_argument("--lines", type=int, default=20000)
+p.add_argument("--chunk_lines", type=int, default=1000)
+p.add_argument("--max_words", type=int, default=450)
+p.add_argument("--compare", action="store_true", help="Also time the previous per-line cleaning path")
+p.set_defaults(func=bench_clean)
+
+p = subparsers.add_parser("quantization", help="Recall@k of quantized embedding storage vs. float32")
+p.add_argument("--shard", type=str, default=None, help="Float32 shard to evaluate (default: synthetic vectors)")
+p.add_argument("--rows", type=int, default=20000)
+p.add_argument("--sample", type=int, default=10000, help="Rows used to fit int8 ranges / the pq codebook")
+p.add_argument("--queries", type=int, default=200)
+p.add_argument("-k", type=int, default=10)
+p.add_argument("--pq_m", type=int, default=96)
+p.add_argument("--codecs", type=str, nargs="+", default=["float32", "float16", "bfloat16", "int8", "pq"])
+p.set_defaults(func=bench_quantization)
+
+p = subparsers.add_parser("search", help="QPS and recall@k of exact vs. IVF search over embedding shards")
+p.add_argument("--shards", type=str, nargs="*", default=None, help="Shards to search (default: synthetic vectors)")
+p.add_argument("--index", type=str, default=None, help="Where to build the IVF index (default: a temp dir)")
+p.add_argument("--rows", type=int, default=100000, help="Rows of synthetic vectors")
+p.add_argument("--metric", type=str, choices=["cosine", "l2"], default="cosine")
+p.add_argument("--nlist", type=int, default=256)
+p.add_argument("--sample", type=int, default=50000, help="Rows used to train the coarse quantizer")
+p.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+p.add_argument("--queries", type=int, default=500)
+p.add_argument("-k", type=int, default=10)
+p.set_defaults(func=bench_search)
+
+p = subparsers.add_parser("pipeline", help="End-to-end throughput sweep with a tiny random model (offline, CPU)")
+p.add_argument("--t5", action="store_true", help="Tiny T5 (T5Processor) instead of a tiny sentence model")
+p.add_argument("-m", "--model", type=str, default=None, help="Model to use instead of the tiny random one")
+p.add_argument("--workdir", type=str, default=None, help="Corpus, tiny model and outputs (default: a temp dir)")
+p.add_argument("--lines", type=int, default=2000)
+p.add_argument("--input_format", type=str, choices=["tsv", "csv"], default="tsv")
+p.add_argument("--max_words", type=int, default=450)
+p.add_argument("--encode_batch_size", type=int, nargs="+", default=[16, 32, 64])
+p.add_argument("--num_workers", type=int, nargs="+", default=[1])
+p.add_argument("--segment_batch_size", type=int, nargs="+", default=[500, 2000])
+p.add_argument("--results", type=str, default=None, help="Also write the results table to this file")
+p.add_argument("extra", nargs=argparse.REMAINDER, help="Further generate-embeddings.py options, after --")
+p.set_defaults(func=bench_pipeline)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    args.func(args)
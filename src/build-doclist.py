@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+
+import sys
+import argparse
+from time import perf_counter
+
+from tiering.doclist import build_doclist
+
+# build-doclist.py docids.txt docids.npy
+#   converts a text --doclist (one docid per line) into a sorted key file that generate-embeddings.py
+#   opens without loading it: --doclist docids.npy
+parser = argparse.ArgumentParser()
+parser.add_argument("source", type=str, help="Text file with one docid per line")
+parser.add_argument("output", type=str, help="Key file to write (.npy)")
+parser.add_argument("--chunk_lines", type=int, default=1 << 22, help="Docids hashed per chunk")
+
+args = parser.parse_args()
+
+start = perf_counter()
+if not args.output.endswith(".npy"):
+    sys.stderr.write("The output name must end in .npy\n")
+    sys.exit(-1)
+distinct = build_doclist(args.source, args.output, args.chunk_lines)
+sys.stderr.write("{} distinct docids in {:0.1f} seconds\n".format(distinct, perf_counter() - start))
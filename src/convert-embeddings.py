@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+
+import sys
+import argparse
+
+from tiering.shards import convert_npz
+
+# call as convert-embeddings.py <name>.embeddings.N.npz [...]
+#   writes <name>.embeddings.N.{vec,ids,json} next to each input
+parser = argparse.ArgumentParser()
+parser.add_argument("inputs", type=str, nargs="+", help="Legacy .npz embedding shards")
+parser.add_argument("--vector_dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16", "int8"])
+
+args = parser.parse_args()
+
+for path in args.inputs:
+    if not path.endswith(".npz"):
+        sys.stderr.write("Skipping {}: not an .npz shard\n".format(path))
+        continue
+    rows = convert_npz(path, path[:-4], dtype=args.vector_dtype)
+    sys.stderr.write("{}: {} rows\n".format(path, rows))
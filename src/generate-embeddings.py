@@ -3,21 +3,51 @@
 import sys
 import argparse
 
-from tiering.embeddings import Embeddings
-
 # call as generate-embeddings.py <input size> <max_source_size> <model>
 parser = argparse.ArgumentParser()
 parser.add_argument("-m", "--model", type=str)
 parser.add_argument("--t5", action="store_true", help="Use T5 embeddings")
-parser.add_argument("-s", "--max_doc_words", type=int, required=True, help="Max # words per sequence")
-parser.add_argument("--input", type=str, required=True)
+parser.add_argument("--t5_encoder_only", action="store_true",
+                    help="Load only the T5 encoder weights (embeddings need nothing else)")
+parser.add_argument("--t5_graph", action="store_true",
+                    help="Run the T5 encoder as a compiled graph over fixed padded shape buckets")
+parser.add_argument("--t5_int8", action="store_true",
+                    help="Dynamic-range int8 quantized T5 encoder (CPU, via TFLite); implies --t5_graph")
+parser.add_argument("--t5_int8_min_cosine", type=float, default=0.99,
+                    help="Stop if int8 vectors of the first batch agree with the float model less than this")
+parser.add_argument("-s", "--max_doc_words", type=int, help="Max # words per sequence")
+parser.add_argument("--input", type=str)
+parser.add_argument("--input_threads", type=int, default=4,
+                    help="Decompression threads for .gz/.zst/.xz/.7z inputs, where the format allows them")
+parser.add_argument("--ascii_only", action="store_true",
+                    help="Delete the non-ASCII bytes of the input (replaces piping it through tr -dc '\\0-\\177')")
 parser.add_argument("-d", "--device", type=str)
-parser.add_argument("-b", "--segment_batch_size", type=int, required=True)
+parser.add_argument("-b", "--segment_batch_size", type=int)
 parser.add_argument("-c", "--cleantext", action="store_true")
 parser.add_argument("-e", "--embeddings", action="store_true")
 parser.add_argument("--encode_batch_size", type=int, default=32)
+parser.add_argument("--encode_processes", type=int, default=0,
+                    help="Encode on CPU in this many processes, each with its own copy of the model (not with --t5)")
+parser.add_argument("--encode_threads", type=int, default=0,
+                    help="Torch threads per --encode_processes process (default: the cores split evenly)")
+parser.add_argument("--segment_tokens", action="store_true",
+                    help="Split documents by the model tokenizer's tokens instead of --max_doc_words words")
+parser.add_argument("--max_segment_tokens", type=int, default=0,
+                    help="Tokens per segment with --segment_tokens (default and cap: the model's max length)")
+parser.add_argument("--segment_overlap", type=int, default=0, help="Tokens shared by consecutive segments")
+parser.add_argument("--max_batch_tokens", type=int, default=0,
+                    help="Length-bucketed batches of at most this many (padded) tokens; "
+                         "--encode_batch_size then caps the rows per batch")
+parser.add_argument("--memory_limit", type=str, default=None,
+                    help="Memory ceiling (e.g. 12G) for adaptive token-budget batches: probes throughput and peak RSS, "
+                         "adjusts per segment length and backs off on allocation failures; "
+                         "--max_batch_tokens is then the starting budget and --encode_batch_size is not used")
 parser.add_argument("-o", "--output", type=str, default="-")
 parser.add_argument("-z", "--compressed", action="store_true", default=True)
+parser.add_argument("--compression", type=str, default="gzip", choices=["gzip", "zstd", "none"],
+                    help="Codec of the cleantext shards (zstd needs the zstandard package)")
+parser.add_argument("--compression_level", type=int, default=None)
+parser.add_argument("--cleantext_format", type=str, default="tsv", choices=["tsv", "jsonl"])
 parser.add_argument("-v", "--verbose", action="store_true")
 parser.add_argument("--maxlines", type=int, default=0, help="Break cleantext output into chunks")
 parser.add_argument("--num_workers", type=int, default=3)
@@ -26,18 +56,143 @@ parser.add_argument("--is_json", action="store_true")
 parser.add_argument("--truncate",  action="store_true")
 parser.add_argument("--lastdoc", type=str, help="Start computations AFTER this document")
 parser.add_argument("--filepostfix", type=int, default=0)
-parser.add_argument("--doclist", type=str, help="Input document filter list; only do docs in this file", default=None)
+parser.add_argument("--resume", action="store_true",
+                    help="Continue after the last shard recorded in <output>.manifest.jsonl")
+parser.add_argument("--vector_dtype", type=str, default="float32",
+                    choices=["float32", "float16", "bfloat16", "int8", "pq"],
+                    help="Storage of the embedding shards: float, bfloat16 bits, per-shard int8, product quantized")
+parser.add_argument("--pq_m", type=int, default=96, help="Sub-vectors (bytes per vector) with --vector_dtype pq")
+parser.add_argument("--quantize_sample", type=int, default=10000,
+                    help="Rows used to fit int8 ranges (per shard) or the pq codebook (first shard)")
+parser.add_argument("--pipeline", action="store_true",
+                    help="Overlap reading/cleaning, encoding and writing in concurrent stages")
+parser.add_argument("--clean_workers", type=int, default=2, help="Cleaning processes in --pipeline mode")
+parser.add_argument("--clean_chunk_lines", type=int, default=1000, help="Input lines per cleaning task")
+parser.add_argument("--queue_depth", type=int, default=0,
+                    help="Cleaned chunks buffered ahead of the encoder (default 2 * clean_workers)")
+parser.add_argument("--cache", type=str, default=None,
+                    help="Path prefix of an on-disk segment embedding cache (created if missing; "
+                         "one per worker with --partitions, <cache>.partN)")
+parser.add_argument("--cache_size", type=int, default=1000000, help="Max cached segment vectors (LRU)")
+parser.add_argument("--partitions", type=int, default=1,
+                    help="Split the input file into this many line-aligned byte ranges, one worker process each")
+parser.add_argument("--threads_per_worker", type=int, default=0,
+                    help="Math library threads per partition worker (default: cores / partitions)")
+parser.add_argument("--metrics", type=str, default=None,
+                    help="Append per-stage timings and rates as JSON lines to this file ('-' for stderr)")
+parser.add_argument("--metrics_interval", type=float, default=30.0, help="Seconds between metrics lines")
+parser.add_argument("--doclist", type=str, default=None,
+                    help="Input document filter list; only do docs in this file (one docid per line, or a key "
+                         "file made by build-doclist.py for large lists)")
+
+parser.add_argument("--summarize", action="store_true",
+                    help="Also write T5 summaries per document to <output>.summaries.N (needs the full --t5 model)")
+parser.add_argument("--summary_beams", type=int, default=4, help="Beam width of summaries; 1 is greedy decoding")
+parser.add_argument("--summary_max_tokens", type=int, default=64, help="Max decode steps (tokens) per summary")
+parser.add_argument("--summary_batch_size", type=int, default=16, help="Documents per generate call")
+parser.add_argument("--summary_batch_tokens", type=int, default=0,
+                    help="Also cap the input tokens per generate call (batches are grouped by length)")
+parser.add_argument("--summary_cache", type=str, default=None,
+                    help="sqlite file caching summaries by document text and decoding options")
+parser.add_argument("--dedup", type=str, default=None, choices=["skip", "alias"],
+                    help="Do not encode near-duplicate documents: drop them (skip), or keep their cleantext and "
+                         "map them to the canonical document in <output>.aliases.N (alias)")
+parser.add_argument("--dedup_threshold", type=float, default=0.8,
+                    help="Estimated Jaccard similarity of word shingles above which documents are near-duplicates")
+parser.add_argument("--dedup_shingle", type=int, default=5, help="Words per shingle")
+parser.add_argument("--dedup_perm", type=int, default=128, help="MinHash permutations (signature length)")
+parser.add_argument("--dedup_capacity", type=int, default=250000,
+                    help="Canonical documents kept in the LSH index (about 3 KB each); the oldest are forgotten")
+parser.add_argument("--tiers", type=int, default=0,
+                    help="Fit this many centroids by streaming mini-batch k-means and write the tier (nearest "
+                         "centroid) and score of every document next to its vector shard (.tier/.score)")
+parser.add_argument("--tier_centroids", type=str, default=None,
+                    help="Score against fixed reference centroids instead (.npy, or .npz with 'centroids' and "
+                         "an optional tier per centroid in 'tiers', e.g. <output>.tiers.npz of an earlier run)")
+parser.add_argument("--tier_metric", type=str, default="cosine", choices=["cosine", "l2"],
+                    help="Tier scores: cosine similarity or squared L2 distance to the nearest centroid")
+parser.add_argument("--serve", type=str, default=None,
+                    help="Keep the model loaded and run jobs sent to this Unix socket ('-': job lines on stdin)")
+parser.add_argument("--server", type=str, default=None,
+                    help="Run this job in the encoder server listening on this Unix socket")
+
+
+# an error message for invalid job options, or None
+def check_args(args):
+    missing = [name for name, value in [("--max_doc_words", args.max_doc_words), ("--input", args.input),
+                                        ("--segment_batch_size", args.segment_batch_size)] if value is None]
+    if missing:
+        return "the following arguments are required: " + ", ".join(missing)
+    if args.lastdoc and not args.filepostfix:
+        return "--lastdoc and --filepostfix must be specified together or not at all"
+    if args.resume and (args.lastdoc or args.filepostfix):
+        return "--resume takes its position from the manifest; drop --lastdoc/--filepostfix"
+    if args.partitions > 1 and args.lastdoc:
+        return "--lastdoc cannot be used with --partitions; use --resume"
+    if args.summarize and (not args.t5 or args.t5_encoder_only or args.output == "-"):
+        return "--summarize needs --t5 with the full model and an --output prefix"
+    if args.encode_processes and (args.t5 or args.memory_limit):
+        return "--encode_processes works with sentence-transformers models and without --memory_limit " \
+               "(which only measures this process)"
+    if args.embeddings and args.output == "-":
+        return "--embeddings writes vector shards <output>.<model>.embeddings.N; it needs an --output prefix"
+    if args.dedup == 'alias' and args.output == "-":
+        return "--dedup alias writes <output>.aliases.N; it needs an --output prefix"
+    if (args.tiers or args.tier_centroids) and (not args.embeddings or args.output == "-"):
+        return "--tiers/--tier_centroids need --embeddings and an --output prefix"
+    if args.tiers and args.tier_centroids:
+        return "--tiers fits centroids, --tier_centroids uses given ones; pick one"
+    if args.tiers and args.partitions > 1:
+        return "--tiers would fit unrelated centroids in each partition; fit them once (e.g. a single-partition " \
+               "run's <output>.tiers.npz) and pass them with --tier_centroids"
+    if args.input_format not in ['tsv', 'csv']:
+        return "Unknown input_format. Must be tsv or csv"
+    if args.segment_tokens and args.model:
+        # segments are cut at token character offsets, which only fast (Rust) tokenizers report
+        from tiering.document_processor import get_tokenizer, segment_size
+        tokenizer = get_tokenizer(args.model)
+        if not tokenizer.is_fast:
+            return "--segment_tokens needs a fast tokenizer for {}; this transformers version has none " \
+                   "(T5 models need a release with T5TokenizerFast)".format(args.model)
+        # each segment advances by size - overlap tokens; an overlap near the size multiplies the segments
+        size = segment_size(tokenizer, args.max_segment_tokens)
+        if not 0 <= args.segment_overlap < size:
+            return "--segment_overlap must be at least 0 and below the {} text tokens of a segment " \
+                   "(--max_segment_tokens less the model's special tokens)".format(size)
+    return None
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    # a server only needs the model options; each job brings the rest
+    if args.serve:
+        from tiering.server import EncoderServer
+        EncoderServer(parser, args, check_args).serve(args.serve)
+        sys.exit(0)
 
-args = parser.parse_args()
+    error = check_args(args)
+    if error:
+        sys.stderr.write(error)
+        sys.exit(-1)
+    if args.lastdoc:
+        sys.stderr.write("Skipping past document {}, file postix {}".format(args.lastdoc, args.filepostfix))
 
-if args.lastdoc and not args.filepostfix:
-    sys.stderr.write("--lastdoc and --filepostfix must be specified together or not at all")
-    sys.exit(-1)
-if args.input_format not in ['tsv', 'csv']:
-    sys.stderr.write("Unknown input_format. Must be tsv or csv")
-    sys.exit(-1)
-if args.lastdoc:
-    sys.stderr.write("Skipping past document {}, file postix {}".format(args.lastdoc, args.filepostfix))
+    # the job runs in the server's process; nothing heavy is imported here
+    if args.server:
+        from tiering.server import submit
+        response = submit(args.server, sys.argv[1:])
+        if not response['ok']:
+            sys.stderr.write("Server error: {}\n".format(response['error']))
+            sys.exit(-1)
+        sys.stderr.write("Done in %0.2f minutes (server)\n" % response['minutes'])
+        sys.exit(0)
 
-t = Embeddings(args).run()
-sys.stderr.write("\nDone in %0.2f minutes\n" % t)
\ No newline at end of file
+    # partition workers are spawned and re-import this file, so only the parent process gets here
+    if args.partitions > 1:
+        from tiering.partitions import run_partitions
+        t = run_partitions(args)
+    else:
+        from tiering.embeddings import Embeddings
+        t = Embeddings(args).run()
+    sys.stderr.write("\nDone in %0.2f minutes\n" % t)
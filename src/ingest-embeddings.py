@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import sys
+import argparse
+
+from tiering.ingestEmbeddings import ShardLoader, LocalMilvus, Milvus
+
+# call as ingest-embeddings.py --collection <name> <output>.<model>.embeddings.*.json
+#   rerunning with the same --state skips the shards already committed
+parser = argparse.ArgumentParser()
+parser.add_argument("shards", type=str, nargs="+", help="Embedding shards (names, or their .json headers)")
+parser.add_argument("--collection", type=str, required=True)
+parser.add_argument("--host", type=str, default="localhost")
+parser.add_argument("--port", type=str, default="19530")
+parser.add_argument("--state", type=str, default=None, help="Load state file (default <collection>.ingest.jsonl)")
+parser.add_argument("--chunk_rows", type=int, default=10000)
+parser.add_argument("--max_in_flight", type=int, default=4)
+parser.add_argument("--retries", type=int, default=5)
+parser.add_argument("--index_type", type=str, default="IVF_FLAT")
+parser.add_argument("--metric_type", type=str, default="L2")
+parser.add_argument("--nlist", type=int, default=1024)
+parser.add_argument("--no_index", action="store_true", help="Skip the index build after loading")
+parser.add_argument("--local", action="store_true", help="Load into an in-process stand-in (dry run)")
+
+args = parser.parse_args()
+
+if not args.local and Milvus is None:
+    sys.stderr.write("pymilvus is not installed; use --local for a dry run\n")
+    sys.exit(-1)
+client = LocalMilvus() if args.local else Milvus(args.host, args.port)
+shards = [name[:-5] if name.endswith(".json") else name for name in args.shards]
+loader = ShardLoader(client, args.collection, args.state or args.collection + ".ingest.jsonl",
+                     chunk_rows=args.chunk_rows, max_in_flight=args.max_in_flight, retries=args.retries,
+                     index_params={"index_type": args.index_type, "metric_type": args.metric_type,
+                                   "params": {"nlist": args.nlist}})
+rows = loader.load(shards, build_index=not args.no_index)
+sys.stderr.write("\nLoaded {} rows into {} ({} total)\n".format(rows, args.collection,
+                                                                client.count_entities(args.collection)))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import sys
+import argparse
+import numpy as np
+
+from tiering.search import ShardSet, ExactSearch, IVFIndex, METRICS
+
+# build an IVF index:   search-embeddings.py build --index <path> <output>.<model>.embeddings.*.json
+# query it (or exact):  search-embeddings.py query [--index <path> | --shards ...] --queries q.npy -k 10
+#   prints query \t rank \t docid \t score, one line per neighbour
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest="command", required=True)
+
+p = subparsers.add_parser("build", help="Build and save an IVF index over embedding shards")
+p.add_argument("shards", type=str, nargs="+", help="Embedding shards (names, or their .json headers)")
+p.add_argument("--index", type=str, required=True, help="Index path prefix")
+p.add_argument("--metric", type=str, choices=METRICS, default="cosine")
+p.add_argument("--nlist", type=int, default=1024)
+p.add_argument("--sample", type=int, default=100000, help="Rows used to train the coarse quantizer")
+p.add_argument("--iters", type=int, default=20)
+
+p = subparsers.add_parser("query", help="Top-k neighbours of a batch of query vectors")
+p.add_argument("--index", type=str, default=None, help="IVF index to search (approximate)")
+p.add_argument("--shards", type=str, nargs="+", default=None, help="Shards to search exactly")
+p.add_argument("--metric", type=str, choices=METRICS, default="cosine", help="Metric of exact search")
+p.add_argument("--queries", type=str, required=True, help=".npy matrix of query vectors, one per row")
+p.add_argument("-k", type=int, default=10)
+p.add_argument("--nprobe", type=int, default=8)
+
+args = parser.parse_args()
+
+if args.command == "build":
+    shards = ShardSet(name[:-5] if name.endswith(".json") else name for name in args.shards)
+    index = IVFIndex.build(args.index, shards, args.nlist, args.metric, args.sample, args.iters)
+    sys.stderr.write("Indexed {} rows of {} shards in {} lists\n".format(shards.rows, len(shards.names),
+                                                                        len(index.centroids)))
+    sys.exit(0)
+
+if (args.index is None) == (args.shards is None):
+    sys.stderr.write("query needs exactly one of --index or --shards\n")
+    sys.exit(-1)
+queries = np.load(args.queries)
+if args.index:
+    index = IVFIndex.load(args.index)
+    shards = index.shards
+    scores, rows = index.search(queries, args.k, args.nprobe)
+else:
+    shards = ShardSet(name[:-5] if name.endswith(".json") else name for name in args.shards)
+    scores, rows = ExactSearch(shards, args.metric).search(queries, args.k)
+for q in range(len(rows)):
+    for rank, (score, row) in enumerate(zip(scores[q], rows[q])):
+        if row >= 0:
+            print("%d\t%d\t%s\t%0.6f" % (q, rank, shards.docid(row), score))
@@ -1,5 +1,7 @@
 #!usr/bin/env python
 
+import numpy as np
+
 from tiering.T5Processor import T5Processor
 
 ARTICLE = """ There are some misconceptions and confusion about what data scientists do day-to-day. There seems to be not a clear understanding of what they deliver, how much coding they do, who they work with, etc. This is not without cause of course. What a data scientist does day-to-day depends a lot on the company, team structure, person or even sometimes on the industry they work in. But I believe there are some common things every data scientist goes through in their daily work.
@@ -95,4 +97,14 @@ t5.fit(ARTICLE, split=True)
 e = t5.doc_embeddings()
 print(e)
 
+# pooling must ignore padding: a short segment encodes the same alone and inside a padded batch
+short = "You accept the compliments on your hard work."
+alone = t5.get_embeddings([short])
+padded = t5.get_embeddings([short, ARTICLE.split("\n")[5]])
+assert np.allclose(alone[0], padded[0], atol=1e-5), "pooled vector depends on batch padding"
+print("padding-independent pooling: ok")
 
+# the encoder-only compiled graph pads to shape buckets and must give the same vectors
+t5g = T5Processor(model="t5-base", encoder_only=True, graph=True)
+assert np.allclose(t5g.get_embeddings([short, ARTICLE.split("\n")[5]]), padded, atol=1e-4), "graph/eager mismatch"
+print("encoder-only graph agrees with eager: ok")
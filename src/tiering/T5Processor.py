@@ -1,8 +1,11 @@
+import sys
+from time import perf_counter
 from transformers import TFT5ForConditionalGeneration, T5Tokenizer
 import tensorflow as tf
 import numpy as np
 
-from .document_processor import DocumentProcessor
+from .document_processor import DocumentProcessor, group_mean
+from .batching import PaddingStats, encode_bucketed
 
 
 # splice a tensor
@@ -12,17 +15,69 @@ def tf_splice(tensor, _start=0, _end=None):
     return tensor[start:end]
 
 
+# padded sequence lengths of the compiled encoder; rows are padded to row_bucket, so a run
+# traces at most a few dozen (rows, length) shapes
+LENGTH_BUCKETS = [16, 32, 64, 128, 256, 512]
+
+
+def length_bucket(length):
+    return next((b for b in LENGTH_BUCKETS if b >= length), length)
+
+
+# rows of a compiled batch: full batches (batch_size rows) are not padded; other row counts are padded to
+# a grid of steps of 1.25 anchored at batch_size (300, 240, 192, 153, ...), so at most 20% of the rows of
+# any batch are padding, token-budget batches stay within 25% of their budget, and the grid stays small
+def row_bucket(rows, batch_size):
+    bucket = max(1, batch_size)
+    while bucket < rows:
+        bucket = int(bucket * 1.25) + 1
+    while True:
+        smaller = int(bucket * 0.8)
+        if smaller < rows or smaller == bucket:
+            return bucket
+        bucket = smaller
+
+
+# row-wise cosine similarity of two matrices
+def cosines(a, b):
+    return np.sum(a * b, axis=1) / np.maximum(np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1), 1e-12)
+
+
 class T5Processor:
 
-    def __init__(self, model="t5-base", batch_size=32):
-        self.model = TFT5ForConditionalGeneration.from_pretrained(model)
+    # max_tokens > 0 batches segments by token budget (see batching.py) instead of batch_size rows
+    # encoder_only: load just the encoder weights (about half the memory); embeddings only, no summarize
+    # graph:        encode + pool as one tf.function over fixed padded shapes (LENGTH_BUCKETS x row_bucket)
+    # int8:         dynamic-range int8 TFLite conversion of that graph (CPU); its vectors on the first batch
+    #               must agree with the float graph to min_cosine, after which an encoder-only float model
+    #               is released
+    def __init__(self, model="t5-base", batch_size=32, max_tokens=0, encoder_only=False, graph=False, int8=False,
+                 min_cosine=0.99):
+        if encoder_only:
+            # TFT5EncoderModel is only in newer transformers releases than the pinned one
+            from transformers import TFT5EncoderModel
+            self.model = TFT5EncoderModel.from_pretrained(model)
+        else:
+            self.model = TFT5ForConditionalGeneration.from_pretrained(model)
+        self.encoder_only = encoder_only
         self.tokenizer = T5Tokenizer.from_pretrained(model)
         # T5 uses a max_length of 512 so we cut the article to 450 tokens to allow t5 'normalization'
         self.doc_processor = DocumentProcessor()
         self.input_ids = None
+        self.attention_mask = None
         self.embeddings = {'word': None, 'doc': None, 'paragraphs': None}
         self.outputs = None
         self.batch_size = batch_size
+        self.dim = self.model.config.d_model
+        self.max_tokens = max_tokens
+        self.padding = PaddingStats()
+        self.metrics = None  # stage timers (see metrics.py), set by Embeddings with --metrics
+        self.controller = None  # adaptive token budget (see autobatch.py), set by Embeddings with --memory_limit
+        self.graph = tf.function(self.pooled) if graph or int8 else None
+        self.min_cosine = min_cosine
+        self.tflite = self.quantize() if int8 else None
+        self.interpreters = {}
+        self.checked = False
 
     def split(self, document, max_words=450, truncate=False, task=""):
         return self.doc_processor.split(document, max_words=max_words, truncate=truncate, prefix=task)
@@ -31,17 +86,107 @@ class T5Processor:
     def fit(self, document, split=True, truncate=True, task=""):
         input_doc = self.split(document, task=task) if split else document
         tokens = self.tokenizer(input_doc, return_tensors="tf", truncation=truncate, padding=True)
+        return self.fit_tokens(tokens)
+
+    def fit_tokens(self, tokens):
         self.input_ids = tokens['input_ids']
-        encodings = self.model.encoder(self.input_ids, attention_mask=tokens['attention_mask'])
+        self.attention_mask = tokens['attention_mask']
+        encodings = self.model.encoder(self.input_ids, attention_mask=self.attention_mask)
 
         #  use mean pooling layer to produce a document embedding (this is what sentence_transformers does)
         self.embeddings['word'] = encodings[0]
         return self
 
+    # encoder states mean-pooled over the real tokens; the body of the compiled graph
+    def pooled(self, input_ids, attention_mask):
+        states = self.model.encoder(input_ids, attention_mask=attention_mask)[0]
+        mask = tf.expand_dims(tf.cast(attention_mask, states.dtype), -1)
+        return tf.reduce_sum(states * mask, axis=1) / tf.maximum(tf.reduce_sum(mask, axis=1), 1.0)
+
+    # int8 dynamic-range quantization of the pooled graph (weights stored as int8, activations float)
+    def quantize(self):
+        concrete = self.graph.get_concrete_function(tf.TensorSpec([None, None], tf.int32, name="input_ids"),
+                                                    tf.TensorSpec([None, None], tf.int32, name="attention_mask"))
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete], self.model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        # T5's relative position buckets need a few TF ops TFLite has no builtins for
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        return converter.convert()
+
+    # the int8 graph on one padded shape; one interpreter per shape bucket
+    def run_int8(self, input_ids, attention_mask):
+        shape = input_ids.shape
+        if shape not in self.interpreters:
+            interpreter = tf.lite.Interpreter(model_content=self.tflite)
+            for detail in interpreter.get_input_details():
+                interpreter.resize_tensor_input(detail['index'], shape)
+            interpreter.allocate_tensors()
+            self.interpreters[shape] = interpreter
+        interpreter = self.interpreters[shape]
+        for detail in interpreter.get_input_details():
+            interpreter.set_tensor(detail['index'], attention_mask if 'mask' in detail['name'] else input_ids)
+        interpreter.invoke()
+        return interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+
+    # compare the int8 vectors of the first batch with the float graph's
+    def check_int8(self, vectors, input_ids, attention_mask):
+        agreement = cosines(vectors, self.graph(input_ids, attention_mask).numpy())
+        sys.stderr.write("int8 encoder vs. float: cosine mean %0.4f, min %0.4f\n" %
+                         (agreement.mean(), agreement.min()))
+        if agreement.min() < self.min_cosine:
+            raise ValueError("int8 encoder disagrees with the float model (min cosine %0.4f < %0.4f)" %
+                             (agreement.min(), self.min_cosine))
+        self.checked = True
+        if self.encoder_only:
+            self.model = None
+            self.graph = None
+
+    # pooled vectors of a tokenized batch, padded up to its shape bucket (pad id and mask 0)
+    def encode_padded(self, input_ids, attention_mask):
+        rows, length = input_ids.shape
+        shape = (row_bucket(rows, self.batch_size), length_bucket(length))
+        ids = np.zeros(shape, dtype=np.int32)
+        mask = np.zeros(shape, dtype=np.int32)
+        ids[:rows, :length] = input_ids
+        mask[:rows, :length] = attention_mask
+        if self.tflite is None:
+            return self.graph(ids, mask).numpy()[:rows]
+        vectors = self.run_int8(ids, mask)
+        if not self.checked:
+            self.check_int8(vectors, ids, mask)
+        return vectors[:rows]
+
+    # paragraph vectors of one mini-batch, from the texts or from their token ids
+    #   records real vs. padded tokens, and the tokenize/encode seconds when metrics are on
+    def encode_batch(self, documents, input_ids=None):
+        t0 = perf_counter()
+        tensors = "tf" if self.graph is None and self.tflite is None else "np"
+        if input_ids is None:
+            tokens = self.tokenizer(documents, return_tensors=tensors, truncation=True, padding=True)
+        else:
+            tokens = self.tokenizer.pad({'input_ids': input_ids}, return_tensors=tensors)
+        t1 = perf_counter()
+        if tensors == "tf":
+            paragraphs = self.fit_tokens(tokens).paragraph_embeddings().numpy()
+            mask = self.attention_mask.numpy()
+        else:
+            mask = tokens['attention_mask']
+            paragraphs = self.encode_padded(tokens['input_ids'], mask)
+        self.padding.add(np.sum(mask, axis=1))
+        if self.metrics is not None:
+            self.metrics.add('tokenize', t1 - t0)
+            self.metrics.add('encode', perf_counter() - t1)
+        return paragraphs
+
     # compute paragraph embeddings given a range or all
+    #   mean over the real tokens only (attention_mask), so a segment's vector does not
+    #   depend on how much padding the other segments of its batch forced on it
     def paragraph_embeddings(self, _start=0, _end=None):
         tensor = tf_splice(self.embeddings['word'], _start=_start, _end=_end)
-        self.embeddings['paragraphs'] = tf.reduce_mean(tensor, axis=1)
+        mask = tf.cast(tf_splice(self.attention_mask, _start=_start, _end=_end), tensor.dtype)
+        total = tf.reduce_sum(tensor * tf.expand_dims(mask, -1), axis=1)
+        counts = tf.maximum(tf.reduce_sum(mask, axis=1, keepdims=True), 1.0)
+        self.embeddings['paragraphs'] = total / counts
         return self.embeddings['paragraphs']
 
     # compute doc embeddings by range
@@ -52,35 +197,65 @@ class T5Processor:
         return self.embeddings['doc']
 
     # compute doc embeddings
-    def get_embeddings(self, documents, groupings=None):
-        s = len(documents)
-        start = 0
-        end = self.batch_size
-        embeddings = None
-        # compute embeddings it in batches
-        while start < s:
-            self.fit(documents[start:end], split=False).paragraph_embeddings()
-            if embeddings is None:
-                embeddings = self.embeddings['paragraphs']
-            else:
-                embeddings = tf.concat([embeddings, self.embeddings['paragraphs']], axis=0)
-            start += self.batch_size
-            end += self.batch_size
-
-        # use a mean pooling layer to compute doc embeddings
-        tensor_list = tf.split(embeddings, groupings)
-        results = np.zeros(shape=[len(groupings), 768], dtype=np.float32)
-        for idx, t in enumerate(tensor_list):
-            results[idx] = tf.reduce_mean(t, axis=0).numpy()
-        return results
+    #   paragraph vectors of each mini-batch go straight into a preallocated buffer,
+    #   then each document is the mean of its groupings[i] consecutive paragraphs
+    #   input_ids: token ids of the documents when the segmenter already has them (split_tokens)
+    def get_embeddings(self, documents, groupings=None, input_ids=None):
+        if self.max_tokens or self.controller is not None:
+            paragraphs = self.bucketed_paragraphs(documents, input_ids)
+        else:
+            s = len(documents)
+            paragraphs = np.empty(shape=[s, self.dim], dtype=np.float32)
+            for start in range(0, s, self.batch_size):
+                end = min(start + self.batch_size, s)
+                paragraphs[start:end] = self.encode_batch(documents[start:end],
+                                                          None if input_ids is None else input_ids[start:end])
+        if groupings is None:
+            return paragraphs
+        t0 = perf_counter()
+        vectors = group_mean(paragraphs, groupings)
+        if self.metrics is not None:
+            self.metrics.add('pool', perf_counter() - t0)
+        return vectors
+
+    # paragraph embeddings over the whole segment batch, tokenized once and encoded in length buckets
+    def bucketed_paragraphs(self, documents, input_ids=None):
+        if input_ids is None:
+            t0 = perf_counter()
+            input_ids = self.tokenizer(documents, truncation=True)['input_ids']
+            if self.metrics is not None:
+                self.metrics.add('tokenize', perf_counter() - t0)
+
+        # encode_batch records the padding of each bucket
+        def encode(idx):
+            return self.encode_batch(None, [input_ids[i] for i in idx])
+
+        lengths = [len(ids) for ids in input_ids]
+        # the controller sizes the batches by memory, not by a row count
+        max_batch = self.batch_size if self.controller is None else 0
+        return encode_bucketed(encode, lengths, self.max_tokens, max_batch, self.dim, controller=self.controller)
 
     # T5 text2text summarization (requires .fit(..., task="summarize:")
-    def summarize(self, max_length=125, min_length=None):
-        self.outputs = self.model.generate(self.input_ids, max_length, min_length=min_length,
-                                           length_penalty=2.0, num_beams=4, early_stopping=True)
+    #   num_beams=1 is greedy decoding; max_length caps the decode steps
+    def summarize(self, max_length=125, min_length=None, num_beams=4):
+        if self.encoder_only:
+            raise ValueError("summarize needs the full model; this T5Processor was loaded encoder_only")
+        self.outputs = self.model.generate(self.input_ids, attention_mask=self.attention_mask, max_length=max_length,
+                                           min_length=min_length, length_penalty=2.0, num_beams=num_beams,
+                                           early_stopping=num_beams > 1)
         return self
 
+    # summaries of a batch of token id sequences (already prefixed with "summarize:"), decoded together
+    def summarize_ids(self, input_ids, max_length=125, min_length=None, num_beams=4):
+        tokens = self.tokenizer.pad({'input_ids': input_ids}, return_tensors="tf")
+        self.input_ids = tokens['input_ids']
+        self.attention_mask = tokens['attention_mask']
+        return self.summarize(max_length, min_length, num_beams).decode()
+
+    def decode(self):
+        return self.tokenizer.batch_decode(self.outputs, skip_special_tokens=True)
+
     def print(self):
-        for ids in self.outputs:
-            print(self.tokenizer.decode(ids))
+        for text in self.decode():
+            print(text)
         return self
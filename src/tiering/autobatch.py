@@ -0,0 +1,151 @@
+import re
+import resource
+from time import perf_counter
+
+
+# "12G", "800M", "1.5g", or plain bytes
+def parse_size(text):
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([kmgt]?)b?\s*', str(text).lower())
+    if match is None:
+        raise ValueError("bad size: {}".format(text))
+    return int(float(match.group(1)) * 1024 ** " kmgt".index(match.group(2) or " "))
+
+
+# allocation failures of numpy, TF (ResourceExhaustedError) and torch (OutOfMemoryError, older CUDA RuntimeErrors)
+def is_oom(e):
+    return isinstance(e, MemoryError) or type(e).__name__ in ('ResourceExhaustedError', 'OutOfMemoryError') \
+        or 'out of memory' in str(e).lower()
+
+
+# resident set size of this process, current and peak since the last reset
+#   the peak (VmHWM) can be reset through /proc/self/clear_refs on Linux; elsewhere it is the peak
+#   of the whole run (getrusage), which still bounds the batches that raised it
+class RSS:
+
+    def __init__(self):
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            self.proc = True
+        except OSError:
+            self.proc = False
+
+    @staticmethod
+    def status(field):
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def current(self):
+        return self.status("VmRSS:") if self.proc else self.peak()
+
+    def reset(self):
+        if self.proc:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+
+    def peak(self):
+        if self.proc:
+            return self.status("VmHWM:")
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# token budget per encode batch under a memory ceiling (--memory_limit)
+#   probing: the first full batches double the budget while tokens/sec still improves by 5% and the
+#            projected peak fits; the budget that was fastest becomes the ceiling
+#   costs:   transient bytes per padded token (batch peak RSS above the resting RSS), per padded-length
+#            class (powers of two); attention makes long segments cost more per token, so each class
+#            gets its own budget, re-estimated after every batch as the length mix changes
+#   backoff: a batch that fails to allocate halves the budget of its class and is retried smaller;
+#            one that peaks above the ceiling lowers it by a quarter
+# RSS is host memory; on GPU only the allocation-failure backoff applies
+class BatchController:
+
+    def __init__(self, memory_limit, start_tokens=4096, min_tokens=256, max_tokens=1 << 20, headroom=0.9,
+                 smoothing=0.3):
+        self.limit = memory_limit * headroom
+        self.ceiling = start_tokens
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.smoothing = smoothing
+        self.probing = True
+        self.best = (0.0, start_tokens)  # (tokens/sec, budget) of the fastest probe
+        self.costs = {}
+        self.caps = {}  # budgets lowered by allocation failures or peaks over the ceiling
+        self.failures = 0
+        self.rss = RSS()
+        self.resting = self.rss.current()
+
+    @staticmethod
+    def length_class(length):
+        return max(16, 1 << (max(1, int(length)) - 1).bit_length())
+
+    # bytes per padded token for a length class; unseen classes borrow the nearest known cost,
+    # scaled up (never down) by the length ratio
+    def cost(self, cls):
+        if cls in self.costs:
+            return self.costs[cls]
+        if not self.costs:
+            return None
+        return max(cost * max(1.0, cls / known) for known, cost in self.costs.items())
+
+    # token budget for a batch whose longest segment has this many tokens
+    def tokens(self, length):
+        cls = self.length_class(length)
+        budget = self.ceiling
+        cost = self.cost(cls)
+        if cost:
+            budget = min(budget, int((self.limit - self.resting) / cost))
+        if cls in self.caps:
+            budget = min(budget, self.caps[cls])
+        return max(self.min_tokens, budget)
+
+    # run encode(idx) for a batch padded to length, measuring its time and peak memory
+    def run(self, encode, idx, length):
+        self.resting = self.rss.current()
+        self.rss.reset()
+        t0 = perf_counter()
+        vectors = encode(idx)
+        self.observe(length, len(idx), perf_counter() - t0, self.rss.peak())
+        return vectors
+
+    def observe(self, length, rows, seconds, peak):
+        cls = self.length_class(length)
+        padded = length * rows
+        cost = max(peak - self.resting, 0) / padded
+        old = self.costs.get(cls)
+        self.costs[cls] = cost if old is None else (1 - self.smoothing) * old + self.smoothing * cost
+        if peak > self.limit:
+            # over the ceiling without failing (allocators keep freed memory resident): back off softly
+            self.probing = False
+            self.caps[cls] = max(self.min_tokens, int(padded * 0.75))
+            self.ceiling = min(self.ceiling, max(self.caps.values()))
+            return
+        if cls in self.caps and padded >= self.caps[cls]:
+            # the capped size went through: let the class grow back slowly
+            self.caps[cls] = int(self.caps[cls] * 1.25)
+        if self.probing and padded >= self.ceiling // 2:
+            self.probe(padded / seconds if seconds > 0 else 0.0)
+
+    def probe(self, rate):
+        if rate < self.best[0] * 1.05:
+            self.probing = False
+            self.ceiling = self.best[1] if rate < self.best[0] else self.ceiling
+            return
+        self.best = (rate, self.ceiling)
+        cost = max(self.costs.values()) if self.costs else 0
+        grown = min(2 * self.ceiling, self.max_tokens)
+        if grown == self.ceiling or (cost and self.resting + cost * grown > self.limit):
+            self.probing = False
+            return
+        self.ceiling = grown
+
+    # an allocation failure: halve this class's budget and stop probing
+    def failed(self, length, rows):
+        cls = self.length_class(length)
+        self.failures += 1
+        self.probing = False
+        self.caps[cls] = max(self.min_tokens, (length * rows) // 2)
+        self.ceiling = max(self.min_tokens, min(self.ceiling, self.caps[cls] * 2))
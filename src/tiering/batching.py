@@ -0,0 +1,79 @@
+import numpy as np
+
+from .autobatch import is_oom
+
+
+# padded vs. real token counts over the batches actually encoded
+class PaddingStats:
+
+    def __init__(self):
+        self.tokens = 0
+        self.padded = 0
+
+    def add(self, lengths):
+        self.tokens += int(np.sum(lengths))
+        self.padded += int(np.max(lengths)) * len(lengths) if len(lengths) else 0
+
+    # fraction of encoded positions that were padding
+    @property
+    def waste(self):
+        return 1.0 - self.tokens / self.padded if self.padded else 0.0
+
+
+# rows of a batch whose first (longest) member has this many tokens, under a token budget
+def batch_rows(length, max_tokens, max_batch=0):
+    rows = max(1, max_tokens // max(1, int(length)))
+    return min(rows, max_batch) if max_batch else rows
+
+
+# group segment indices into batches by a token budget, longest first:
+#   a batch costs (longest member) * (rows), which must stay <= max_tokens
+#   (a single segment longer than the budget still gets its own batch);
+#   max_batch caps the number of rows per batch
+def plan_batches(lengths, max_tokens, max_batch=0):
+    lengths = np.asarray(lengths)
+    order = np.argsort(-lengths, kind='stable')
+    batches = []
+    start = 0
+    while start < len(order):
+        # sorted descending, so the first member sets the padded length of the batch
+        rows = batch_rows(lengths[order[start]], max_tokens, max_batch)
+        batches.append(order[start:start + rows])
+        start += rows
+    return batches
+
+
+# encode segments in length-bucketed batches and scatter the rows back into input order
+#   encode(idx) returns the vectors of segments idx, in that order
+#   controller: a BatchController (see autobatch.py) that sets the budget of each batch instead of
+#               max_tokens, and on an allocation failure the batch is retried with a smaller budget
+def encode_bucketed(encode, lengths, max_tokens, max_batch, dim, stats=None, controller=None):
+    lengths = np.asarray(lengths)
+    out = np.empty(shape=[len(lengths), dim], dtype=np.float32)
+    if controller is None:
+        for idx in plan_batches(lengths, max_tokens, max_batch):
+            out[idx] = encode(idx)
+            if stats is not None:
+                stats.add(lengths[idx])
+        return out
+
+    order = np.argsort(-lengths, kind='stable')
+    start = 0
+    while start < len(order):
+        longest = int(lengths[order[start]])
+        rows = batch_rows(longest, controller.tokens(longest), max_batch)
+        idx = order[start:start + rows]
+        try:
+            out[idx] = controller.run(encode, idx, longest)
+        except Exception as e:
+            if not is_oom(e):
+                raise
+            controller.failed(longest, len(idx))
+            # no smaller batch to fall back to
+            if batch_rows(longest, controller.tokens(longest), max_batch) >= len(idx):
+                raise
+            continue
+        if stats is not None:
+            stats.add(lengths[idx])
+        start += rows
+    return out
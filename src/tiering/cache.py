@@ -0,0 +1,116 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+
+# content-addressed, on-disk cache of segment vectors; a cache <path> is four files:
+#   <path>.vec   (capacity, dim) float32 memmap of vectors, one slot per entry
+#   <path>.keys  (capacity, 16) memmap of the key whose vector each slot holds (zeros while it is rewritten)
+#   <path>.idx   keys and their slots, least recently used first (written by flush())
+#   <path>.json  dim/capacity header
+# keys hash (model, max_doc_words, cleaned segment text), so one cache can serve several models;
+# when full, the least recently used slot is reused
+class EmbeddingCache:
+
+    def __init__(self, path, dim, capacity, model, max_words, flush_every=100000):
+        self.path = path
+        self.dim = dim
+        self.capacity = capacity
+        self.flush_every = flush_every
+        self.prefix = hashlib.blake2b("{}\0{}\0".format(model, max_words).encode("utf8"), digest_size=16)
+        self.slots = OrderedDict()
+        self.used = 0  # slots [0, used) have been written at some time
+        self.free = []  # slots below used that hold no indexed entry (dropped as stale on open)
+        self.hits = 0
+        self.misses = 0
+        self.dirty = 0
+        if os.path.exists(path + ".json"):
+            with open(path + ".json", "r") as f:
+                header = json.load(f)
+            if header['dim'] != dim:
+                raise ValueError("cache {} holds {}-d vectors, model produces {}-d".format(path, header['dim'], dim))
+            self.capacity = header['capacity']
+            self.vectors = np.memmap(path + ".vec", dtype=np.float32, mode='r+', shape=(self.capacity, dim))
+            owned = os.path.exists(path + ".keys")
+            self.owners = np.memmap(path + ".keys", dtype=np.uint8, mode='r+' if owned else 'w+',
+                                    shape=(self.capacity, 16))
+            if os.path.exists(path + ".idx"):
+                with np.load(path + ".idx") as idx:
+                    keys, slots = idx['keys'], idx['slots']
+                if owned:
+                    # slots reused after the index was last written no longer hold their indexed key
+                    valid = np.all(self.owners[slots] == keys, axis=1)
+                    keys, slots = keys[valid], slots[valid]
+                else:
+                    # a cache from before .keys existed: its index is all there is
+                    self.owners[slots] = keys
+                for key, slot in zip(keys, slots):
+                    self.slots[key.tobytes()] = int(slot)
+            # new entries go to slots no indexed entry holds, never to the next slot after len(slots)
+            written = np.flatnonzero(np.any(self.owners, axis=1))
+            self.used = int(written[-1]) + 1 if len(written) else 0
+            indexed = np.fromiter(self.slots.values(), dtype=np.int64, count=len(self.slots))
+            self.free = np.setdiff1d(np.arange(self.used), indexed).tolist()
+        else:
+            self.vectors = np.memmap(path + ".vec", dtype=np.float32, mode='w+', shape=(capacity, dim))
+            self.owners = np.memmap(path + ".keys", dtype=np.uint8, mode='w+', shape=(capacity, 16))
+            with open(path + ".json", "w") as f:
+                json.dump({'dim': dim, 'capacity': capacity}, f)
+
+    def key(self, text):
+        h = self.prefix.copy()
+        h.update(text.encode("utf8"))
+        return h.digest()
+
+    # vectors for keys: returns (vectors, missing) where rows of missing keys are left unset
+    def get(self, keys):
+        out = np.empty(shape=[len(keys), self.dim], dtype=np.float32)
+        missing = []
+        for idx, key in enumerate(keys):
+            slot = self.slots.get(key)
+            if slot is None:
+                missing.append(idx)
+                continue
+            self.slots.move_to_end(key)
+            out[idx] = self.vectors[slot]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        return out, missing
+
+    def put(self, keys, vectors):
+        for key, vector in zip(keys, vectors):
+            if key in self.slots:
+                continue
+            if self.free:
+                slot = self.free.pop()
+            elif self.used < self.capacity:
+                slot = self.used
+                self.used += 1
+            else:
+                _, slot = self.slots.popitem(last=False)
+            # the persisted index may still map an earlier key here; unclaim the slot before rewriting it
+            self.owners[slot] = 0
+            self.slots[key] = slot
+            self.vectors[slot] = vector
+            self.owners[slot] = np.frombuffer(key, dtype=np.uint8)
+        self.dirty += len(keys)
+        if self.dirty >= self.flush_every:
+            self.flush()
+
+    # persist vectors and slot owners, then the index (atomically); after a crash, index entries whose slot
+    # was reused since (its owner is another key, or zeros mid-rewrite) are dropped when the cache is opened
+    def flush(self):
+        self.vectors.flush()
+        self.owners.flush()
+        keys = np.frombuffer(b"".join(self.slots.keys()), dtype=np.uint8).reshape(-1, 16)
+        slots = np.fromiter(self.slots.values(), dtype=np.int64, count=len(self.slots))
+        with open(self.path + ".idx.tmp", "wb") as f:
+            np.savez(f, keys=keys, slots=slots)
+        os.replace(self.path + ".idx.tmp", self.path + ".idx")
+        self.dirty = 0
+
+    def close(self):
+        self.flush()
+        del self.vectors, self.owners
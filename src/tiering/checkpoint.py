@@ -0,0 +1,35 @@
+import os
+import json
+
+
+# checkpoint manifest: one JSON line appended per closed output shard
+#   {"postfix": N, "lines": input lines consumed, "offset": input bytes consumed,
+#    "lastdoc": last docid written, "input": input name}
+# everything up to "offset" is in shards 0..N, so a rerun can start at offset with postfix N + 1
+class Manifest:
+
+    def __init__(self, path):
+        self.path = path
+
+    def entries(self):
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # torn last line from a crash mid-write; the previous entries still hold
+                    break
+        return entries
+
+    def last(self):
+        entries = self.entries()
+        return entries[-1] if entries else None
+
+    def append(self, entry):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
@@ -1,55 +1,172 @@
-import json
 import re
 import sys
+from time import perf_counter
 
-from .document_processor import DocumentProcessor
+from .document_processor import DocumentProcessor, get_tokenizer
+from .doclist import open_doclist
+from .inputs import open_input, read_lines, discard
+
+
+try:
+    # faster json parsing; optional
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+# two substitutions measure faster than one fused pattern: re scans for a single character class
+# (or a literal) with a fast search loop, while a fused pattern is a match attempt at every space
+remove_chars = re.compile(r'[\n\|/\x00-\x09\x0c-\x1f\x80-\xff]')
+multiple_spaces = re.compile(r'  +')
+bad_content = "bad utf-8 encoding"
+
+
+# extract and normalize the body of an input record
+def clean_body(content, is_json):
+    if not is_json:
+        return content
+    return multiple_spaces.sub(' ', remove_chars.sub(' ', json_loads(content)["body"]))
+
+
+# clean_body followed by split(body), adding the seconds of each step to timings['parse'/'clean'/'split']
+def timed_split(content, is_json, split, timings):
+    t0 = perf_counter()
+    body = json_loads(content)["body"] if is_json else content
+    t1 = perf_counter()
+    if is_json:
+        body = multiple_spaces.sub(' ', remove_chars.sub(' ', body))
+    t2 = perf_counter()
+    segments = split(body)
+    t3 = perf_counter()
+    timings['parse'] += t1 - t0
+    timings['clean'] += t2 - t1
+    timings['split'] += t3 - t2
+    return segments
+
+
+# clean and split a batch of (docid, content) records; runs in a worker process in pipelined mode
+#   returns (docids, segments, groups, input_ids): the segments of docids[i] are the next groups[i] entries
+#   of segments; with token_model set, segments are packed by that model's tokenizer and input_ids holds
+#   their token ids (otherwise None)
+#   timings: optional dict of parse/clean/split seconds to add to (see metrics.py)
+def clean_records(records, max_words, truncate, is_json, token_model=None, max_tokens=0, overlap=0,
+                  timings=None):
+    doc_processor = DocumentProcessor()
+    tokenizer = get_tokenizer(token_model) if token_model else None
+    if tokenizer:
+        def split(body):
+            return doc_processor.split_tokens(body, tokenizer, max_tokens, overlap, truncate)
+    else:
+        def split(body):
+            return doc_processor.split(body, max_words=max_words, truncate=truncate)
+    docids = []
+    segments = []
+    for docid, content in records:
+        docids.append(docid)
+        if timings is None:
+            segments.extend(split(clean_body(content, is_json)))
+        else:
+            segments.extend(timed_split(content, is_json, split, timings))
+    return docids, segments, doc_processor.doc_groups, doc_processor.input_ids if tokenizer else None
+
+
+# batch cleaning of raw input lines (docid <sep> url <sep> content), same result layout as clean_records
+def clean_lines(lines, max_words, truncate=False, is_json=True, input_format="tsv", **segmentation):
+    separator = "\t" if input_format == 'tsv' else ','
+    records = []
+    for line in lines:
+        if bad_content in line:
+            continue
+        docid, url, content = line.split(separator, 2)
+        records.append((docid, content))
+    return clean_records(records, max_words, truncate, is_json, **segmentation)
 
 
 class Cleantext:
 
     def __init__(self, inputname, max_tokens, args):
         self.fname = inputname
-        self.bad_content = "bad utf-8 encoding"
+        self.bad_content = bad_content
         self.args = args
         self.totlines = 0
+        self.offset = 0  # input bytes consumed
+        self.end = None  # stop at this offset (byte-range partitions)
+        self.resuming = False
         self.actual_records = 0
         self.documents = []
         self.input_format = args.input_format
         self.is_json = args.is_json
         self.doc_processor = DocumentProcessor()
         self.max_words = max_tokens
-        self.remove_chars = re.compile(r'[\n\|/\x00-\x09\x0c-\x1f\x80-\xff]')
-        self.multiple_spaces = re.compile(r'  +')
+        # tokenizer-exact segmentation (--segment_tokens): pack segments by the model's own tokens
+        self.token_model = args.model if args.segment_tokens else None
+        self.tokenizer = get_tokenizer(self.token_model) if self.token_model else None
+        self.metrics = None  # set by Embeddings with --metrics
         self.doclist = None
         if args.doclist:
             sys.stderr.write("Using document filtering....\n")
-            self.doclist = set(line.strip() for line in open(args.doclist, 'r'))
+            self.doclist = open_doclist(args.doclist)
 
 
     # split an input into maxsize segments; (enforce max # tokens)
     def partition(self, body):
-        docs = self.doc_processor.split(body, max_words=self.max_words, truncate=self.args.truncate)
+        if self.tokenizer:
+            docs = self.doc_processor.split_tokens(body, self.tokenizer, self.args.max_segment_tokens,
+                                                   self.args.segment_overlap, self.args.truncate)
+        else:
+            docs = self.doc_processor.split(body, max_words=self.max_words, truncate=self.args.truncate)
         size = len(docs)
         idx = 0
         for doc in docs:
             idx += 1
             yield doc, idx == size
 
-    # process input from corpus
-    #   segment is tsv:   docid \t url \t json-body
-    def next_record(self):
-        if self.fname == "-":
-            # this requires python 3.7+
-            # sys.stdin.reconfigure(errors="replace")
-            f = sys.stdin
+    # continue after a checkpoint (see checkpoint.py): lines/offset already consumed by a previous run
+    def resume(self, lines, offset):
+        self.totlines = lines
+        self.offset = offset
+        self.resuming = True
+
+    # only read the lines in [start, end); both must be line boundaries
+    def restrict(self, start, end):
+        self.offset = start
+        self.end = end
+        self.resuming = True
+
+    # position the input past the checkpoint: seek if possible, otherwise read and drop the bytes unparsed
+    def skip_consumed(self, f):
+        if f.seekable():
+            f.seek(self.offset)
         else:
-            f = open(self.fname, "r", encoding="utf8", errors="replace")
-        for line in f:
+            sys.stderr.write("Input is not seekable; skipping {} bytes\n".format(self.offset))
+            discard(f, self.offset)
+        self.resuming = False
+
+    # read input lines that pass the doclist/lastdoc filters
+    #   segment is tsv:   docid \t url \t json-body
+    #   input is read as bytes (decompressed in process, see inputs.py) so that self.offset tracks the
+    #   position for checkpoints
+    def next_line(self):
+        f = open_input(self.fname, self.args.input_threads)
+        try:
+            yield from self.filter_lines(f)
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+
+    def filter_lines(self, f):
+        if self.resuming:
+            self.skip_consumed(f)
+        for size, raw in read_lines(f, self.args.ascii_only):
+            if self.end is not None and self.offset >= self.end:
+                break
             self.totlines += 1
+            self.offset += size
+            line = raw.decode("utf8", errors="replace")
             if self.bad_content in line:
                 continue
 
-            docid, url, content = line.split("\t" if self.input_format == 'tsv' else ',')
+            docid, url, content = line.split("\t" if self.input_format == 'tsv' else ',', 2)
 
             if self.doclist:
                 if docid not in self.doclist:
@@ -65,18 +182,38 @@ class Cleantext:
                 self.args.lastdoc = None  # clear the flag
                 continue  # start on next document
 
+            yield docid, content
+
+    # process input from corpus
+    def next_record(self):
+        if self.metrics is not None:
+            yield from self.timed_records()
+            return
+        for docid, content in self.next_line():
             self.documents.append(docid)
             self.actual_records += 1
 
-            if self.args.is_json:
-                body = json.loads(content)["body"]
-                body = self.remove_chars.sub(' ', body)
-                body = self.multiple_spaces.sub(' ', body)
-            else:
-                body = content
+            body = clean_body(content, self.is_json)
             for idx, (section, eod) in enumerate(self.partition(body)):
                 yield self.totlines, self.actual_records, docid + "." + str(idx), section, eod
 
+    # next_record with the read/parse/clean/split stages timed (--metrics)
+    def timed_records(self):
+        lines = self.next_line()
+        timings = self.metrics.seconds
+        while True:
+            t0 = perf_counter()
+            record = next(lines, None)
+            timings['read'] += perf_counter() - t0
+            if record is None:
+                return
+            docid, content = record
+            self.documents.append(docid)
+            self.actual_records += 1
+            sections = timed_split(content, self.is_json, lambda body: list(self.partition(body)), timings)
+            for idx, (section, eod) in enumerate(sections):
+                yield self.totlines, self.actual_records, docid + "." + str(idx), section, eod
+
     def clear(self):
         self.doc_processor.clear()
         self.documents.clear()
@@ -0,0 +1,151 @@
+import re
+import zlib
+import numpy as np
+
+
+words = re.compile(r'\w+')
+
+
+# LSH banding for a Jaccard threshold: the most rows per band (fewest candidates) that still makes a pair
+# at the threshold a candidate with probability >= recall; candidates are then checked on their signatures
+def lsh_bands(threshold, num_perm, recall=0.95):
+    for rows in range(num_perm, 0, -1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            return bands, rows
+    return num_perm, 1
+
+
+# streaming near-duplicate filter: MinHash signatures of word shingles, looked up in an in-memory LSH index
+#   documents are checked in input order; one whose estimated Jaccard similarity to an indexed document
+#   is >= threshold is a duplicate of it (its canonical document), any other is indexed as a canonical one
+#   memory is bounded: at most capacity canonical documents are indexed (about 3 KB each with the
+#   defaults), the oldest are forgotten first
+#   a band bucket keeps the last bucket_size documents with that band key, not just the last one: templated
+#   pages share many band keys, and a single slot per bucket lets each new page hide the earlier ones from
+#   the bands they share, below the recall lsh_bands plans for; a bucket overflows only when more than
+#   bucket_size canonical documents agree on all rows of a band (a bucket of one is stored as the bare
+#   slot, since most are)
+#   hashing is seeded, so runs over the same input find the same duplicates
+class NearDuplicates:
+
+    def __init__(self, threshold=0.8, num_perm=128, shingle=5, capacity=250000, bucket_size=8, seed=1):
+        self.threshold = threshold
+        self.bucket_size = bucket_size
+        self.shingle = shingle
+        self.capacity = capacity
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        rng = np.random.default_rng(seed)
+        high = np.iinfo(np.uint64).max
+        # multiply-shift hash family: h(x) = (a * x + b) mod 2^64 >> 32, a odd
+        self.a = rng.integers(0, high, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, high, num_perm, dtype=np.uint64)
+        self.shingle_mix = rng.integers(0, high, shingle, dtype=np.uint64) | np.uint64(1)
+        self.band_mix = rng.integers(0, high, self.rows, dtype=np.uint64) | np.uint64(1)
+        self.signatures = np.zeros(shape=[capacity, num_perm], dtype=np.uint32)
+        self.keys = np.zeros(shape=[capacity, self.bands], dtype=np.uint64)
+        self.docids = [None] * capacity
+        self.tables = [{} for _ in range(self.bands)]  # per band: band key -> slot, or slots oldest first
+        self.next = 0
+        self.documents = 0
+        self.duplicates = 0
+        self.segments = 0  # segments of duplicates, not encoded
+
+    # distinct hashes of the word shingles of a text (the whole text is one shingle if it is shorter)
+    def shingles(self, text):
+        tokens = words.findall(text.lower())
+        if not tokens:
+            return None
+        hashes = np.array([zlib.crc32(token.encode("utf8")) for token in tokens], dtype=np.uint64)
+        k = min(self.shingle, len(hashes))
+        n = len(hashes) - k + 1
+        combined = np.zeros(n, dtype=np.uint64)
+        for j in range(k):
+            combined += hashes[j:j + n] * self.shingle_mix[j]
+        return np.unique(combined)
+
+    # MinHash signature, over blocks of shingles to bound the temporary (num_perm, block) array
+    def signature(self, shingles, block=4096):
+        signature = np.full(len(self.a), np.iinfo(np.uint32).max, dtype=np.uint32)
+        for start in range(0, len(shingles), block):
+            x = shingles[start:start + block]
+            hashed = ((self.a[:, None] * x[None, :] + self.b[:, None]) >> np.uint64(32)).astype(np.uint32)
+            np.minimum(signature, hashed.min(axis=1), out=signature)
+        return signature
+
+    def band_keys(self, signature):
+        bands = signature[:self.bands * self.rows].reshape(self.bands, self.rows).astype(np.uint64)
+        return (bands * self.band_mix[None, :]).sum(axis=1)
+
+    # canonical document of a text, or None if it is new (it is then indexed under docid)
+    def check(self, docid, text):
+        self.documents += 1
+        shingles = self.shingles(text)
+        if shingles is None:
+            return None
+        signature = self.signature(shingles)
+        keys = self.band_keys(signature)
+        candidates = set()
+        for table, key in zip(self.tables, keys.tolist()):
+            bucket = table.get(key)
+            if type(bucket) is list:
+                candidates.update(bucket)
+            elif bucket is not None:
+                candidates.add(bucket)
+        if candidates:
+            slots = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            similarity = (self.signatures[slots] == signature[None, :]).mean(axis=1)
+            best = int(np.argmax(similarity))
+            if similarity[best] >= self.threshold:
+                self.duplicates += 1
+                return self.docids[slots[best]]
+        self.add(docid, signature, keys)
+        return None
+
+    def add(self, docid, signature, keys):
+        slot = self.next
+        self.next = (self.next + 1) % self.capacity
+        if self.docids[slot] is not None:
+            # forget the oldest document; it may already have overflowed out of some of its buckets
+            for table, key in zip(self.tables, self.keys[slot].tolist()):
+                bucket = table.get(key)
+                if bucket == slot:
+                    del table[key]
+                elif type(bucket) is list and slot in bucket:
+                    bucket.remove(slot)
+                    if len(bucket) == 1:
+                        table[key] = bucket[0]
+        self.docids[slot] = docid
+        self.signatures[slot] = signature
+        self.keys[slot] = keys
+        for table, key in zip(self.tables, keys.tolist()):
+            bucket = table.get(key)
+            if bucket is None:
+                table[key] = slot
+            elif type(bucket) is not list:
+                table[key] = [bucket, slot] if self.bucket_size > 1 else slot
+            else:
+                if len(bucket) >= self.bucket_size:
+                    del bucket[0]
+                bucket.append(slot)
+
+    # drop the near-duplicate documents of a batch (groups[i]: segments of documents[i])
+    #   returns the kept (segments, batch, documents, groups, input_ids) and (docid, canonical) pairs
+    def filter(self, segments, batch, documents, groups, input_ids=None):
+        kept = []
+        aliases = []
+        offset = 0
+        for docid, count in zip(documents, groups):
+            canonical = self.check(docid, " ".join(batch[offset:offset + count]))
+            if canonical is None:
+                kept.append((docid, offset, count))
+            else:
+                aliases.append((docid, canonical))
+                self.segments += count
+            offset += count
+        if not aliases:
+            return (segments, batch, documents, groups, input_ids), aliases
+        rows = [row for _, offset, count in kept for row in range(offset, offset + count)]
+        return ([segments[row] for row in rows], [batch[row] for row in rows], [docid for docid, _, _ in kept],
+                [count for _, _, count in kept],
+                None if input_ids is None else [input_ids[row] for row in rows]), aliases
@@ -0,0 +1,79 @@
+import os
+import hashlib
+from itertools import islice
+import numpy as np
+
+
+NPY_MAGIC = b"\x93NUMPY"
+
+
+# 64-bit key of a docid: two different docids of a list share a key with probability ~ n^2 / 2^65,
+# negligible even for billions of ids
+def docid_key(docid):
+    return int.from_bytes(hashlib.blake2b(docid.encode("utf8"), digest_size=8).digest(), "little")
+
+
+def docid_keys(docids):
+    return np.fromiter((docid_key(docid) for docid in docids), dtype=np.uint64)
+
+
+# sorted, distinct docid keys in one .npy file, built by build-doclist.py
+#   opening only maps the file, so startup and resident memory do not grow with the list; membership is
+#   a binary search over the mapped keys (the pages it touches stay cached)
+class DocList:
+
+    def __init__(self, path):
+        self.keys = np.load(path, mmap_mode='r')
+        self.size = len(self.keys)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, docid):
+        key = np.uint64(docid_key(docid))
+        idx = self.keys.searchsorted(key)
+        return idx < self.size and self.keys[idx] == key
+
+
+# build a DocList at path from a text file of docids (one per line, surrounding whitespace ignored)
+#   keys are hashed chunk by chunk into a raw temporary file, sorted there in place through a memory map
+#   and copied to the .npy without duplicates, so only the keys (8 bytes per docid) are ever in memory
+def build_doclist(source, path, chunk_lines=1 << 22, block=1 << 24):
+    tmp = path + ".tmp"
+    count = 0
+    with open(source, "r", encoding="utf8") as f, open(tmp, "wb") as out:
+        while True:
+            lines = list(islice(f, chunk_lines))
+            if not lines:
+                break
+            out.write(docid_keys(line.strip() for line in lines).tobytes())
+            count += len(lines)
+    try:
+        if count == 0:
+            np.save(path, np.zeros(0, dtype=np.uint64))
+            return 0
+        keys = np.memmap(tmp, dtype=np.uint64, mode='r+', shape=(count,))
+        keys.sort()
+        keep = np.empty(count, dtype=bool)
+        keep[0] = True
+        np.not_equal(keys[1:], keys[:-1], out=keep[1:])
+        distinct = int(np.count_nonzero(keep))
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint64, shape=(distinct,))
+        n = 0
+        for start in range(0, count, block):
+            part = keys[start:start + block][keep[start:start + block]]
+            out[n:n + len(part)] = part
+            n += len(part)
+        out.flush()
+        del keys, out
+        return distinct
+    finally:
+        os.remove(tmp)
+
+
+# --doclist: a DocList file, or a plain text list of docids loaded into a set
+def open_doclist(path):
+    with open(path, "rb") as f:
+        if f.read(len(NPY_MAGIC)) == NPY_MAGIC:
+            return DocList(path)
+    return set(line.strip() for line in open(path, 'r'))
@@ -1,4 +1,39 @@
 import re
+import numpy as np
+
+
+# mean of consecutive runs of rows: groups[i] is the number of rows (segments) of document i,
+# as recorded in DocumentProcessor.doc_groups; one vectorized pass instead of a loop over documents
+def group_mean(vectors, groups):
+    groups = np.asarray(groups, dtype=np.int64)
+    offsets = np.zeros(len(groups), dtype=np.int64)
+    np.cumsum(groups[:-1], out=offsets[1:])
+    sums = np.add.reduceat(vectors, offsets, axis=0)
+    return np.divide(sums, groups[:, None].astype(sums.dtype), out=sums)
+
+
+# matches one chunk of up to max_words words, from the start of its first word to the end of its last;
+# \w and \W are disjoint, so the match is linear in the chunk length
+def chunk_pattern(max_words):
+    return re.compile(r'\w+(?:\W+\w+){0,%d}' % (max_words - 1))
+
+
+_tokenizers = {}
+
+
+# tokens of text per segment with --segment_tokens: max_tokens (default and cap: the model's max length)
+# less the special tokens the model adds
+def segment_size(tokenizer, max_tokens=0):
+    limit = tokenizer.model_max_length if tokenizer.model_max_length < 100000 else 512
+    return min(max_tokens or limit, limit) - tokenizer.num_special_tokens_to_add()
+
+
+# fast tokenizer of a model, loaded once per process (segmentation also runs in cleaning workers)
+def get_tokenizer(model):
+    if model not in _tokenizers:
+        from transformers import AutoTokenizer
+        _tokenizers[model] = AutoTokenizer.from_pretrained(model, use_fast=True)
+    return _tokenizers[model]
 
 
 class DocumentProcessor():
@@ -6,33 +41,62 @@ class DocumentProcessor():
     def __init__(self):
         # allow some growth
         self.bad_content = "bad utf-8 encoding"
-        self.remove_chars = re.compile(r'[\n\|/\x00-\x09\x0c\x0e-0x1f\x80-\xff]')
         self.words = re.compile(r'\w+')
         self.spaces = re.compile(r'  +')
+        self.chunks = {}
         self.doc_groups = []
+        self.input_ids = []  # per segment, filled by split_tokens
+
+    def chunk_re(self, max_words):
+        if max_words not in self.chunks:
+            self.chunks[max_words] = chunk_pattern(max_words)
+        return self.chunks[max_words]
 
     # split the input into maxsize words partitions
+    #   each partition is a slice of the body (max_words words, with the text between them);
+    #   the regex engine finds the chunk boundaries, no per-word lists or joins
     def split(self, body, truncate=False, max_words=512, prefix=""):
         if prefix is None:
             prefix = ""
-        tokens = self.words.findall(body)
-        size = len(tokens)
-        if size <= max_words:
+        chunks = self.chunk_re(max_words).finditer(body)
+        first = next(chunks, None)
+        second = next(chunks, None) if first else None
+        if second is None:
             self.doc_groups.append(1)
             return [prefix + body]
         if truncate:
             self.doc_groups.append(1)
-            return [prefix + " ".join(tokens[0:min(max_words, len(tokens)) - 1])]
-        else:
-            partitions = []
-            start = 0
-            end = max_words - 1
-            while start <= size - 1:
-                partitions.append(prefix + " ".join(tokens[start:end]))
-                start += max_words
-                end += max_words
-            self.doc_groups.append(len(partitions))
+            return [prefix + first.group()]
+        partitions = [prefix + first.group(), prefix + second.group()]
+        partitions.extend(prefix + m.group() for m in chunks)
+        self.doc_groups.append(len(partitions))
+        return partitions
+
+    # split the input into segments of at most max_tokens model tokens (special tokens included;
+    # default and cap: the model's max length), consecutive segments sharing overlap tokens
+    #   segments are slices of the body at the tokenizer's offsets, and their token ids are kept
+    #   in self.input_ids so the encoder does not tokenize them again
+    def split_tokens(self, body, tokenizer, max_tokens=0, overlap=0, truncate=False):
+        size = segment_size(tokenizer, max_tokens)
+        if not 0 <= overlap < size:
+            raise ValueError("segment overlap {} must be below the {} tokens of a segment".format(overlap, size))
+        encoding = tokenizer(body, add_special_tokens=False, return_offsets_mapping=True)
+        ids = encoding['input_ids']
+        offsets = encoding['offset_mapping']
+        if len(ids) <= size:
+            self.doc_groups.append(1)
+            self.input_ids.append(tokenizer.build_inputs_with_special_tokens(ids))
+            return [body]
+        partitions = []
+        for start in range(0, len(ids), size - overlap):
+            end = min(start + size, len(ids))
+            partitions.append(body[offsets[start][0]:offsets[end - 1][1]])
+            self.input_ids.append(tokenizer.build_inputs_with_special_tokens(ids[start:end]))
+            if truncate or end == len(ids):
+                break
+        self.doc_groups.append(len(partitions))
         return partitions
 
     def clear(self):
         self.doc_groups.clear()
+        self.input_ids.clear()
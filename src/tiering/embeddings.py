@@ -1,16 +1,25 @@
+import os
 import sys
-import zipfile
-from time import process_time
-import numpy as np
+from time import perf_counter
 
-import tensorflow as tf
 from .cleantext import Cleantext
-from .sentence2vec import Sentence2Vec
-from .T5Processor import T5Processor
+from .batching import PaddingStats
+from .shards import ShardWriter, TextShardWriter, shard_name
+from .pipeline import Pipeline
+from .cache import EmbeddingCache
+from .checkpoint import Manifest
+from .quantize import make_codec
+from .metrics import Metrics
+from .autobatch import BatchController, parse_size
+from .document_processor import group_mean
+from .summaries import Summarizer
+from .dedup import NearDuplicates
+from .tiers import Tiering, TierWriter
 
 
 #  initialize the GPU environment
 def init_gpu():
+    import tensorflow as tf
     gpus = tf.config.experimental.list_physical_devices('GPU')
     if gpus:
         try:
@@ -25,14 +34,37 @@ def init_gpu():
             print(e)
 
 
+# the options that determine the vectorizer; jobs sharing a resident vectorizer (see server.py) must agree on them
+VECTORIZER_OPTIONS = ['model', 't5', 'device', 'encode_batch_size', 'num_workers', 'max_batch_tokens',
+                      't5_encoder_only', 't5_graph', 't5_int8', 't5_int8_min_cosine', 'encode_processes',
+                      'encode_threads']
+
+
+# the model backend is imported here, so only the chosen one (TensorFlow or torch) is ever loaded
+def make_vectorizer(args):
+    if args.t5:
+        from .T5Processor import T5Processor
+        return T5Processor(args.model, batch_size=args.encode_batch_size, max_tokens=args.max_batch_tokens,
+                           encoder_only=args.t5_encoder_only, graph=args.t5_graph, int8=args.t5_int8,
+                           min_cosine=args.t5_int8_min_cosine)
+    from .sentence2vec import Sentence2Vec
+    return Sentence2Vec(args.model, args.device, args.encode_batch_size, args.num_workers,
+                        max_tokens=args.max_batch_tokens, processes=args.encode_processes,
+                        threads=args.encode_threads)
+
+
 class Embeddings:
 
-    def __init__(self, args):
+    # byte_range: (start, end) of the input to process, for partitioned runs (see partitions.py)
+    # vectorizer: an already loaded vectorizer to reuse (made with the same VECTORIZER_OPTIONS)
+    def __init__(self, args, byte_range=None, vectorizer=None):
         # init_gpu()
         self.args = args
         self.segments = []
         self.batch = []
         self.cleaner = Cleantext(args.input, args.max_doc_words, args)
+        if byte_range is not None:
+            self.cleaner.restrict(*byte_range)
         self.segment_batch_size = int(args.segment_batch_size)
         self.encode_batch_size = args.encode_batch_size
         self.postfix = args.filepostfix
@@ -40,107 +72,355 @@ class Embeddings:
         self.currlines = 0
         self.input_format = args.input_format
         self.t5 = args.t5
-        if args.embeddings:
-            if self.t5:
-                self.vectorizer = T5Processor(args.model, batch_size=args.encode_batch_size)
+        # --summarize generates with the T5 model of the vectorizer
+        if args.embeddings or args.summarize:
+            if vectorizer is None:
+                self.vectorizer = make_vectorizer(args)
             else:
-                self.vectorizer = Sentence2Vec(args.model, args.device, args.encode_batch_size, args.num_workers)
-        self.new_vectors_file()
+                # per-run state of a reused vectorizer starts fresh
+                self.vectorizer = vectorizer
+                self.vectorizer.padding = PaddingStats()
+        # per-stage timers and counters (--metrics); None when off, so the stages skip the clock calls
+        self.metrics = None
+        if args.metrics:
+            self.metrics = Metrics(args.metrics, args.metrics_interval)
+            self.cleaner.metrics = self.metrics
+        # token budget per encode batch under a memory ceiling (--memory_limit), starting from --max_batch_tokens
+        self.controller = None
+        if args.embeddings and args.memory_limit:
+            self.controller = BatchController(parse_size(args.memory_limit), args.max_batch_tokens or 4096)
+        if args.embeddings or args.summarize:
+            self.vectorizer.metrics = self.metrics
+            self.vectorizer.controller = self.controller
+        self.summarizer = None
+        if args.summarize:
+            self.summarizer = Summarizer(self.vectorizer, args.summary_beams, args.summary_max_tokens,
+                                         batch_size=args.summary_batch_size, max_tokens=args.summary_batch_tokens,
+                                         cache=args.summary_cache, model=args.model)
+        self.cache = None
+        self.dedup = None
+        if args.dedup:
+            self.dedup = NearDuplicates(args.dedup_threshold, args.dedup_perm, args.dedup_shingle, args.dedup_capacity)
+        if args.embeddings and args.cache:
+            self.cache = EmbeddingCache(args.cache, self.vectorizer.dim, args.cache_size, args.model,
+                                        args.max_doc_words)
+        self.manifest = None
+        self.position = None
+        if args.output != "-":
+            self.manifest = Manifest(args.output + ".manifest.jsonl")
+            if args.resume:
+                self.resume()
+        self.tiering = self.make_tiering()
+        self.tier_model = None
+        self.em_shard = None
+        self.ti_shard = None
+        self.pq_codec = None
+        self.cl_shard = None
+        self.su_shard = None
+        self.al_shard = None
+        # set when a shard was closed and the next one is opened by the next write with rows, so a shard
+        # full at the end of the input is not followed by an empty one
+        self.rotated = False
         if args.output == "-":
-            self.cl_zf = sys.stdout
             self.compressed = False
-            self.em_zf = None
         else:
-            if self.args.cleantext:
-                self.new_cleantext_file()
+            self.new_files()
 
         sys.stderr.write("Starting....\n")
 
-    # using zip format for universal compatibility;
-    # change if more compression needed (e.g. if your OS supports it; i.e. 7z)
+    # pick up after the last shard a previous run closed
+    def resume(self):
+        entry = self.manifest.last()
+        if entry is None:
+            sys.stderr.write("No checkpoint in {}; starting from the beginning\n".format(self.manifest.path))
+            return
+        # the offsets are positions in that input; another file would silently resume mid-record
+        if 'input' in entry and entry['input'] != self.args.input:
+            raise ValueError("{} checkpoints input {}, not {}".format(self.manifest.path, entry['input'],
+                                                                       self.args.input))
+        self.postfix = entry['postfix'] + 1
+        self.cleaner.resume(entry['lines'], entry['offset'])
+        sys.stderr.write("Resuming after document {} (line {}), file postfix {}\n".format(
+            entry['lastdoc'], entry['lines'], self.postfix))
+
+    # tier assignment of the document vectors (--tiers / --tier_centroids), None when off
+    #   an online model is saved at every checkpoint and picked up again by --resume
+    def make_tiering(self):
+        if self.args.tier_centroids:
+            return Tiering.load(self.args.tier_centroids, self.args.tier_metric)
+        if not self.args.tiers:
+            return None
+        model = self.args.output + ".tiers.npz"
+        if self.args.resume and os.path.exists(model):
+            sys.stderr.write("Continuing the tier centroids of {}\n".format(model))
+            return Tiering.load(model, self.args.tier_metric, fixed=False)
+        return Tiering(self.args.tiers, self.args.tier_metric)
+
+    # record a closed shard; position is (lines, offset) of the input right after its last document
+    def checkpoint(self):
+        if self.manifest is None or self.position is None:
+            return
+        if self.tier_model is not None:
+            self.tier_model.save(self.args.output + ".tiers.npz")
+        lines, offset, lastdoc = self.position
+        self.manifest.append({'postfix': self.postfix, 'lines': lines, 'offset': offset, 'lastdoc': lastdoc,
+                              'input': self.args.input})
+
+    # one streaming text shard per postfix, compressed in independently decodable frames with a side index
+    # (see shards.py); without --compressed the shard is plain text, still indexed
     def new_cleantext_file(self):
-        postfix = ".cleantext.{}".format(self.postfix)
-        if self.args.compressed:
-            self.cl_zf = zipfile.ZipFile(self.args.output + postfix + ".zip", mode='w',
-                                         compression=zipfile.ZIP_DEFLATED)
-        else:
-            self.cl_zf = open(self.args.output + postfix + ".tsv", "w")
+        name = self.args.output + ".cleantext.{}".format(self.postfix)
+        codec = self.args.compression if self.args.compressed else 'none'
+        self.cl_shard = TextShardWriter(name, self.args.cleantext_format, codec, self.args.compression_level)
 
-    # using zip format for universal compatibility;
-    # change if more compression needed (e.g. if your OS supports it; i.e. 7z)
+    # document summaries: docid \t summary rows in a text shard next to the cleantext shard of the same postfix
+    def new_summary_file(self):
+        name = self.args.output + ".summaries.{}".format(self.postfix)
+        codec = self.args.compression if self.args.compressed else 'none'
+        self.su_shard = TextShardWriter(name, self.args.cleantext_format, codec, self.args.compression_level)
+
+    # near-duplicates (--dedup alias): docid \t canonical docid rows; a duplicate has no row in the vector
+    # shards, its vector is the canonical document's
+    def new_alias_file(self):
+        name = self.args.output + ".aliases.{}".format(self.postfix)
+        codec = self.args.compression if self.args.compressed else 'none'
+        self.al_shard = TextShardWriter(name, self.args.cleantext_format, codec, self.args.compression_level)
+
+    # embeddings go to a contiguous shard (see shards.py); float vectors barely compress,
+    # so the shard is left raw and memory-mappable
     def new_vectors_file(self):
-        # embeddings always compressed
-        postfix = ".embeddings.{}.npz".format(self.postfix)
-        self.em_zf = zipfile.ZipFile(self.args.output + "." + self.args.model + postfix, mode='w',
-                                     compression=zipfile.ZIP_DEFLATED)
-
-    def dump_numpy_row(self, row):
-        tmpname = "{}.npy".format(self.cleaner.documents[self.rowidx])
-        self.em_zf.writestr(tmpname, row.tobytes())
-        self.rowidx += 1
-
-    def dump_cleantext_row(self, doc, row):
-        if self.args.compressed:
-            tmpname = "{}.cleantext.tsv".format(doc)
-            self.cl_zf.writestr(tmpname, "%s\t%s\n" % (doc, row))
+        name = shard_name(self.args.output, self.args.model, self.postfix)
+        if self.args.vector_dtype == 'pq':
+            # one product-quantization codebook for the run, trained on the first shard
+            if self.pq_codec is None:
+                self.pq_codec = make_codec('pq', self.args.pq_m)
+            self.em_shard = ShardWriter(name, codec=self.pq_codec, train_rows=self.args.quantize_sample)
         else:
-            self.cl_zf.write("%s\t%s\n" % (doc, row))
+            self.em_shard = ShardWriter(name, self.args.vector_dtype, train_rows=self.args.quantize_sample)
+        if self.tiering is not None:
+            self.ti_shard = TierWriter(name)
 
-    def dump_embedding(self, embeddings):
-        if self.em_zf:
-            self.rowidx = 0
-            np.apply_along_axis(self.dump_numpy_row, axis=1, arr=embeddings)
-
-    def dump(self):
-        tt1 = 0
-        tt2 = 0
-        t0 = process_time()
+    # open the output shards of the current postfix
+    def new_files(self):
         if self.args.cleantext:
-            t1 = process_time()
-            for doc, body in zip(self.segments, self.batch):
-                self.dump_cleantext_row(doc, body)
-                self.currlines += 1
-            t2 = process_time()
-            tt1 = t2 - t1
-        if self.args.embeddings:
-            t1 = process_time()
-            embeddings = self.vectorizer.get_embeddings(self.batch, self.cleaner.doc_processor.doc_groups)
-            t2 = process_time()
-            tt2 = t2 - t1
-            self.dump_embedding(embeddings)
-        # advance the file postfix; close and reopen new file
-        if 0 < self.maxlines <= self.currlines:
-            self.postfix += 1
-            if self.args.compressed:
-                self.cl_zf.close()
             self.new_cleantext_file()
-            self.em_zf.close()
+        if self.args.embeddings:
             self.new_vectors_file()
+        if self.summarizer:
+            self.new_summary_file()
+        if self.args.dedup == 'alias':
+            self.new_alias_file()
+
+    def dump_cleantext(self, segments, batch):
+        if self.cl_shard:
+            self.cl_shard.write(segments, batch)
+        else:
+            sys.stdout.write("".join("%s\t%s\n" % (doc, row) for doc, row in zip(segments, batch)))
+
+    def dump_embedding(self, documents, embeddings):
+        if self.em_shard:
+            self.em_shard.append(documents, embeddings)
+
+    # write one batch (cleantext rows, document vectors, summaries, aliases and tiers), then advance the output
+    # files if full
+    #   position: (lines, offset, lastdoc) of the input right after the batch's last document
+    #   tiers: (tier, score) arrays of the documents, aligned with the vector shard rows
+    #   tier_model: snapshot of the online tier model right after the batch, saved by the next checkpoint
+    def write(self, segments, batch, documents, embeddings, position, summaries=None, aliases=None, tiers=None,
+              tier_model=None):
+        t0 = perf_counter()
+        if self.rotated and segments:
+            self.new_files()
+            self.rotated = False
+        if self.args.cleantext and segments:
+            self.dump_cleantext(segments, batch)
+        if embeddings is not None:
+            self.dump_embedding(documents, embeddings)
+        if summaries is not None:
+            self.su_shard.write(documents, summaries)
+        if aliases and self.al_shard:
+            self.al_shard.write(*zip(*aliases))
+        if tiers is not None and self.ti_shard:
+            self.ti_shard.append(*tiers)
+        self.currlines += len(segments)
+        self.position = position
+        if tier_model is not None:
+            self.tier_model = tier_model
+        # advance the file postfix; close the full files, the next write with rows opens new ones
+        if 0 < self.maxlines <= self.currlines and self.args.output != "-":
+            self.close_files()
+            self.checkpoint()
+            self.postfix += 1
+            self.rotated = True
             self.currlines = 0
-        return tt1, tt2, process_time() - t0
+        if self.metrics is not None:
+            self.metrics.add('write', perf_counter() - t0)
+            self.metrics.count('documents', len(documents))
+            self.metrics.count('segments', len(segments))
+
+    # encode (and summarize) one batch of whole documents; returns the arguments of write()
+    #   near-duplicates (--dedup) are not encoded; with --dedup alias their cleantext is still written
+    #   and they are listed with their canonical document, with --dedup skip they are dropped entirely
+    #   position: (lines, offset) of the input right after the batch's last document
+    #   an online tier model is snapshot with the batch: under --pipeline the writer checkpoints while the
+    #   next batches are assigned, and must save the model as of the checkpointed position
+    def prepare(self, segments, batch, documents, groups, input_ids, position):
+        position = position + (documents[-1],)
+        aliases = None
+        cleantext = segments, batch
+        if self.dedup is not None:
+            (segments, batch, documents, groups, input_ids), aliases = \
+                self.dedup.filter(segments, batch, documents, groups, input_ids)
+            if self.args.dedup == 'skip':
+                cleantext = segments, batch
+        embeddings = summaries = tiers = tier_model = None
+        if documents:
+            embeddings = self.encode(batch, groups, input_ids)
+            summaries = self.summarize(batch, groups)
+        if self.tiering is not None and embeddings is not None:
+            tiers = self.tiering.assign(embeddings)
+        if self.tiering is not None and not self.tiering.fixed:
+            tier_model = self.tiering.snapshot()
+        return cleantext + (documents, embeddings, position, summaries, aliases, tiers, tier_model)
+
+    #   input_ids: token ids per segment from tokenizer-exact segmentation, else None
+    def encode(self, batch, groups, input_ids=None):
+        if not self.args.embeddings:
+            return None
+        if self.cache is None:
+            return self.vectorizer.get_embeddings(batch, groups, input_ids)
+        paragraphs = self.cached_paragraphs(batch, input_ids)
+        t0 = perf_counter()
+        vectors = group_mean(paragraphs, groups)
+        if self.metrics is not None:
+            self.metrics.add('pool', perf_counter() - t0)
+        return vectors
+
+    # one summary per document, from the start of its text (T5 truncates the input at 512 tokens, so
+    # only the first two segments are passed on)
+    def summarize(self, batch, groups):
+        if self.summarizer is None:
+            return None
+        texts = []
+        offset = 0
+        for count in groups:
+            texts.append(" ".join(batch[offset:offset + min(count, 2)]))
+            offset += count
+        return self.summarizer.summarize(texts)
+
+    # segment vectors, encoding only the segments not in the cache (each distinct text once)
+    def cached_paragraphs(self, batch, input_ids=None):
+        keys = [self.cache.key(text) for text in batch]
+        paragraphs, missing = self.cache.get(keys)
+        if missing:
+            first = {}
+            for idx in missing:
+                first.setdefault(keys[idx], idx)
+            unique = list(first.values())
+            ids = None if input_ids is None else [input_ids[idx] for idx in unique]
+            vectors = self.vectorizer.get_embeddings([batch[idx] for idx in unique], None, ids)
+            self.cache.put([keys[idx] for idx in unique], vectors)
+            rows = dict(zip(first.keys(), vectors))
+            for idx in missing:
+                paragraphs[idx] = rows[keys[idx]]
+        return paragraphs
+
+    # extra verbose progress fields
+    def stats(self):
+        note = ""
+        if self.args.embeddings and (self.args.max_batch_tokens or self.controller is not None):
+            note += ", padding %0.3f" % self.vectorizer.padding.waste
+        if self.controller is not None:
+            note += ", batch tokens %d%s" % (self.controller.ceiling, " (probing)" if self.controller.probing else "")
+        if self.cache is not None:
+            note += ", cache hits %d misses %d" % (self.cache.hits, self.cache.misses)
+        if self.summarizer is not None and self.summarizer.cache is not None:
+            note += ", summaries cached %d generated %d" % (self.summarizer.cache.hits, self.summarizer.cache.misses)
+        if self.dedup is not None:
+            note += ", near-duplicates %d (%d segments not encoded)" % (self.dedup.duplicates, self.dedup.segments)
+        return note
+
+    # update the run-wide counters and emit a metrics line if one is due (once per batch)
+    #   gauges: extra point-in-time values, e.g. queue depths
+    def observe(self, **gauges):
+        if self.metrics is None:
+            return
+        self.metrics.total('lines', self.cleaner.totlines)
+        if self.args.embeddings:
+            self.metrics.total('tokens', self.vectorizer.padding.tokens)
+            self.metrics.total('padded', self.vectorizer.padding.padded)
+        if self.cache is not None:
+            gauges.update(cache_hits=self.cache.hits, cache_misses=self.cache.misses)
+        if self.controller is not None:
+            gauges.update(batch_tokens=self.controller.ceiling, oom_retries=self.controller.failures)
+        if self.dedup is not None:
+            gauges.update(duplicates=self.dedup.duplicates, segments_not_encoded=self.dedup.segments)
+        for name, value in gauges.items():
+            self.metrics.gauge(name, value)
+        self.metrics.tick()
+
+    # encode and write the current batch; returns the wall-clock seconds of (write, encode, both)
+    def dump(self):
+        t0 = perf_counter()
+        item = self.prepare(self.segments, self.batch, self.cleaner.documents, self.cleaner.doc_processor.doc_groups,
+                            self.cleaner.doc_processor.input_ids or None, (self.cleaner.totlines, self.cleaner.offset))
+        t1 = perf_counter()
+        self.write(*item)
+        t2 = perf_counter()
+        self.observe()
+        return t2 - t1, t1 - t0, t2 - t0
+
+    def close_files(self):
+        if self.cl_shard:
+            self.cl_shard.close()
+        if self.em_shard:
+            self.em_shard.close()
+        if self.su_shard:
+            self.su_shard.close()
+        if self.al_shard:
+            self.al_shard.close()
+        if self.ti_shard:
+            self.ti_shard.close()
+
+    def close(self):
+        if not self.rotated:
+            self.close_files()
+        if self.currlines:
+            self.checkpoint()
+        if self.cache is not None:
+            self.cache.close()
+        if self.summarizer is not None:
+            self.summarizer.close()
+        if self.dedup is not None:
+            sys.stderr.write("\nNear-duplicates: %d of %d documents; %d segments (about %d encoder batches) not encoded\n"
+                             % (self.dedup.duplicates, self.dedup.documents, self.dedup.segments,
+                                -(-self.dedup.segments // self.args.encode_batch_size)))
+        if self.metrics is not None:
+            self.observe()
+            self.metrics.close()
 
     def run(self):
-        __t0 = process_time()
-        start = process_time()
+        if self.args.pipeline:
+            return Pipeline(self).run()
+        start = perf_counter()
         for idx, (totlines, actual_lines, segment, body, eod) in enumerate(self.cleaner.next_record()):
             self.segments.append(segment)
             self.batch.append(body)
             if eod and len(self.segments) > self.args.segment_batch_size:
+                segments = len(self.segments)
                 t1, t2, t3 = self.dump()
                 self.segments.clear()
                 self.batch.clear()
                 self.cleaner.clear()
                 if self.args.verbose:
-                    sys.stderr.write("\r%d (%d, %d): %0.4f, %0.4f, %0.4f" % (totlines,
-                                                                 actual_lines,
-                                                                 idx,
-                                                                 (totlines / __t0),
-                                                                 (self.segment_batch_size / t2),
-                                                                 (self.segment_batch_size / t3)
-                                                                ))
+                    # input lines/sec over the run; segments/sec of this batch's encode, and encode + write
+                    sys.stderr.write("\r%d (%d, %d): %0.1f lines/s, %0.1f, %0.1f segments/s" % (
+                        totlines, actual_lines, idx, totlines / (perf_counter() - start),
+                        segments / t2, segments / t3))
+                    sys.stderr.write(self.stats())
                 else:
                     sys.stderr.write("\r%d (%d, %d)" % (totlines, actual_lines, idx))
         if len(self.segments) > 0:
             self.dump()
-        end = process_time()
-        return (end - start) / 60
+        self.close()
+        return (perf_counter() - start) / 60
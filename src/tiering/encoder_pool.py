@@ -0,0 +1,174 @@
+import os
+import atexit
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+
+# CPU encoding in several processes, each with its own SentenceTransformer and a fixed number of torch threads
+#   one process with many intra-op threads stops scaling long before a large node runs out of cores; a few
+#   processes with a few threads each (pinned to their own cores where there are enough) keep them busy
+#   every worker has two shared-memory buffers: the utf-8 texts of its task (offsets + bytes) and the
+#   float32 vectors it writes back, so only (rows, batch_size) and (status, rows) go through its pipe
+#   tasks are slices of the batch sorted by length (little padding per task), handed to whichever worker
+#   is free, and the vectors are scattered back into input order
+
+
+# one task's worth of shared buffers, as seen from either process
+class TaskBuffers:
+
+    def __init__(self, inputs, outputs, max_rows, dim):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.offsets = np.ndarray((max_rows + 1,), dtype=np.int64, buffer=inputs.buf)
+        self.text = inputs.buf[8 * (max_rows + 1):]
+        self.vectors = np.ndarray((max_rows, dim), dtype=np.float32, buffer=outputs.buf)
+
+    def put_texts(self, texts):
+        np.cumsum([len(text) for text in texts], out=self.offsets[1:len(texts) + 1])
+        data = b"".join(texts)
+        self.text[:len(data)] = data
+
+    def get_texts(self, rows):
+        data = bytes(self.text[:self.offsets[rows]])
+        return [data[start:end].decode("utf8") for start, end in zip(self.offsets[:rows], self.offsets[1:rows + 1])]
+
+    def release(self):
+        # views into the buffers must go before the buffers can be closed
+        del self.offsets, self.text, self.vectors
+        self.inputs.close()
+        self.outputs.close()
+
+
+def encoder_worker(conn, modelpath, threads, cores, inputs, outputs, max_rows, dim):
+    # the thread count must be set before torch is imported
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    if cores:
+        os.sched_setaffinity(0, cores)
+    import torch
+    torch.set_num_threads(threads)
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(modelpath, device="cpu")
+    buffers = TaskBuffers(SharedMemory(name=inputs), SharedMemory(name=outputs), max_rows, dim)
+    conn.send(('ready', model.get_sentence_embedding_dimension()))
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        rows, batch_size = task
+        try:
+            buffers.vectors[:rows] = model.encode(buffers.get_texts(rows), batch_size=batch_size)
+            conn.send(('done', rows))
+        except Exception as e:
+            conn.send(('error', "{}: {}".format(type(e).__name__, e)))
+    buffers.release()
+
+
+class EncoderPool:
+
+    # threads: torch threads per process (default: the available cores split evenly)
+    # max_rows, input_bytes: capacity of a task (segments, utf-8 bytes of their text)
+    def __init__(self, modelpath, dim, processes, threads=0, max_rows=4096, input_bytes=1 << 26):
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        ncores = len(cores) or os.cpu_count() or 1
+        self.threads = threads or max(1, ncores // processes)
+        self.dim = dim
+        self.max_rows = max_rows
+        self.input_bytes = input_bytes
+        self.workers = []
+        self.closed = False
+        ctx = multiprocessing.get_context("spawn")
+        pin = len(cores) >= processes * self.threads
+        for idx in range(processes):
+            inputs = SharedMemory(create=True, size=8 * (max_rows + 1) + input_bytes)
+            outputs = SharedMemory(create=True, size=4 * max_rows * dim)
+            conn, child = ctx.Pipe()
+            worker_cores = cores[idx * self.threads:(idx + 1) * self.threads] if pin else None
+            proc = ctx.Process(target=encoder_worker, name="encoder-%d" % idx, daemon=True,
+                               args=(child, modelpath, self.threads, worker_cores, inputs.name, outputs.name,
+                                     max_rows, dim))
+            proc.start()
+            child.close()
+            self.workers.append((conn, proc, TaskBuffers(inputs, outputs, max_rows, dim)))
+        atexit.register(self.close)
+        for conn, proc, _ in self.workers:
+            status, value = self.receive(conn, proc)
+            if status != 'ready' or value != dim:
+                self.close()
+                raise RuntimeError("encoder process failed to start: {}".format(value))
+
+    @staticmethod
+    def receive(conn, proc):
+        try:
+            return conn.recv()
+        except EOFError:
+            raise RuntimeError("encoder process {} exited (status {})".format(proc.name, proc.exitcode))
+
+    # contiguous (start, end) slices of the length-sorted texts, each within the task capacity and about
+    # two per worker, so a worker that draws long texts does not hold up the batch; the split depends only
+    # on the number of workers (a task need not be whole batches: each worker batches its own rows), so a
+    # token-budget bucket or a batch of a few batch_size runs still spreads over every worker
+    def plan(self, texts):
+        per_task = min(self.max_rows, max(1, -(-len(texts) // (2 * len(self.workers)))))
+        tasks = []
+        start = 0
+        size = 0
+        for idx, text in enumerate(texts):
+            if idx > start and (idx - start >= per_task or size + len(text) > self.input_bytes):
+                tasks.append((start, idx))
+                start = idx
+                size = 0
+            if len(text) > self.input_bytes:
+                raise ValueError("segment of {} bytes exceeds the encoder task buffer".format(len(text)))
+            size += len(text)
+        if start < len(texts):
+            tasks.append((start, len(texts)))
+        return tasks
+
+    # vectors of a batch of texts, in order
+    def encode(self, batch, batch_size):
+        vectors = np.empty(shape=[len(batch), self.dim], dtype=np.float32)
+        order = np.argsort([len(text) for text in batch], kind='stable')
+        texts = [batch[idx].encode("utf8") for idx in order]
+        pending = deque(self.plan(texts))
+        idle = list(self.workers)
+        busy = {}
+        errors = []
+        while busy or (pending and not errors):
+            while pending and idle and not errors:
+                worker = idle.pop()
+                start, end = pending.popleft()
+                worker[2].put_texts(texts[start:end])
+                worker[0].send((end - start, batch_size))
+                busy[worker[0]] = (worker, start, end)
+            for conn in wait(list(busy)):
+                worker, start, end = busy.pop(conn)
+                status, value = self.receive(conn, worker[1])
+                if status == 'error':
+                    errors.append(value)
+                else:
+                    vectors[order[start:end]] = worker[2].vectors[:end - start]
+                idle.append(worker)
+        if errors:
+            raise RuntimeError("encoder process failed: {}".format(errors[0]))
+        return vectors
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for conn, proc, buffers in self.workers:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for conn, proc, buffers in self.workers:
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.terminate()
+            conn.close()
+            buffers.release()
+            buffers.inputs.unlink()
+            buffers.outputs.unlink()
@@ -1,11 +1,30 @@
 """
 This is runnable for Milvus(0.11.x) and pymilvus(0.3.x).
 """
+import os
+import sys
+import json
 import random
 import csv
+import threading
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 
-from milvus import Milvus, DataType
+import numpy as np
+
+from .shards import ShardReader
+
+try:
+    from milvus import Milvus, DataType
+except ImportError:
+    # pymilvus is only needed to talk to a server; LocalMilvus below stands in for it
+    Milvus = None
+
+    class DataType:
+        INT32 = "INT32"
+        INT64 = "INT64"
+        FLOAT_VECTOR = "FLOAT_VECTOR"
 
 
 class MyMilvus():
@@ -149,3 +168,153 @@ class MyMilvus():
         # Summary:
         #     Now we've went through some basic build index operations, hope it's helpful!
         # ------
+
+
+# in-process stand-in for the subset of the pymilvus 0.3 client used here (tests, dry runs)
+#   fail_inserts: number of insert calls to fail before succeeding, to exercise retries
+class LocalMilvus():
+
+    def __init__(self, fail_inserts=0):
+        self.collections = {}
+        self.indexes = {}
+        self.fail_inserts = fail_inserts
+        self.inserts = 0
+        self.lock = threading.Lock()
+
+    def list_collections(self):
+        return list(self.collections)
+
+    def create_collection(self, name, param):
+        self.collections[name] = {}
+
+    def drop_collection(self, name):
+        self.collections.pop(name, None)
+        self.indexes.pop(name, None)
+
+    def insert(self, name, entities, ids):
+        with self.lock:
+            self.inserts += 1
+            if self.fail_inserts > 0:
+                self.fail_inserts -= 1
+                raise ConnectionError("simulated insert failure")
+            vectors = entities[0]["values"]
+            self.collections[name].update(zip(ids, vectors))
+        return ids
+
+    def delete_entity_by_id(self, name, ids):
+        with self.lock:
+            for entity_id in ids:
+                self.collections[name].pop(entity_id, None)
+
+    def flush(self, names):
+        pass
+
+    def count_entities(self, name):
+        return len(self.collections[name])
+
+    def create_index(self, name, field, params):
+        self.indexes[name] = (field, params)
+
+    def get_collection_info(self, name):
+        return {"rows": self.count_entities(name), "index": self.indexes.get(name)}
+
+
+# bulk loader from embedding shards (shards.py) into a Milvus collection
+#   each shard is streamed in chunk_rows slices, inserted by up to max_in_flight concurrent requests with
+#   retries, flushed, then recorded as committed in the state file; the index is built once at the end
+#   entity ids are base + row, where each shard gets its own base (a multiple of 2^32), kept in the state file;
+#   a shard that was started but never committed has its id range deleted before it is loaded again
+class ShardLoader():
+
+    def __init__(self, client, collection_name, state_path, field="embedding", chunk_rows=10000,
+                 max_in_flight=4, retries=5, backoff=1.0, index_params=None):
+        self.client = client
+        self.collection_name = collection_name
+        self.state_path = state_path
+        self.field = field
+        self.chunk_rows = chunk_rows
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.index_params = index_params or {"index_type": "IVF_FLAT", "metric_type": "L2", "params": {"nlist": 1024}}
+        self.state = self.load_state()
+
+    def load_state(self):
+        state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    state[entry["shard"]] = entry
+        return state
+
+    def record(self, shard, base, rows, status):
+        entry = {"shard": shard, "base": base, "rows": rows, "status": status}
+        self.state[shard] = entry
+        with open(self.state_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def ensure_collection(self, dim):
+        if self.collection_name not in self.client.list_collections():
+            self.client.create_collection(self.collection_name, {
+                "fields": [{"name": self.field, "type": DataType.FLOAT_VECTOR, "params": {"dim": dim}}],
+                "segment_row_limit": 1000000,
+                "auto_id": False
+            })
+
+    def insert(self, vectors, ids):
+        entities = [{"name": self.field, "values": vectors.tolist(), "type": DataType.FLOAT_VECTOR}]
+        for attempt in range(self.retries + 1):
+            try:
+                return self.client.insert(self.collection_name, entities, ids)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                sys.stderr.write("insert of {} rows failed ({}), retrying\n".format(len(ids), e))
+                sleep(self.backoff * 2 ** attempt)
+
+    def load_shard(self, pool, shard):
+        reader = ShardReader(shard)
+        entry = self.state.get(shard)
+        if entry is None:
+            base = len(self.state) << 32
+        else:
+            base = entry["base"]
+            sys.stderr.write("{} was interrupted; removing its partial rows\n".format(shard))
+            self.client.delete_entity_by_id(self.collection_name, list(range(base, base + reader.rows)))
+        self.ensure_collection(reader.dim)
+        self.record(shard, base, reader.rows, "started")
+
+        # bounded in-flight requests: at most max_in_flight chunks are decoded and waiting at any time
+        slots = threading.BoundedSemaphore(self.max_in_flight)
+        futures = []
+        for start in range(0, reader.rows, self.chunk_rows):
+            end = min(start + self.chunk_rows, reader.rows)
+            slots.acquire()
+            vectors = np.asarray(reader[start:end], dtype=np.float32)
+            future = pool.submit(self.insert, vectors, list(range(base + start, base + end)))
+            future.add_done_callback(lambda f: slots.release())
+            futures.append(future)
+        for future in futures:
+            future.result()
+        self.client.flush([self.collection_name])
+        self.record(shard, base, reader.rows, "committed")
+        return reader.rows
+
+    # load shards in order, skipping committed ones; returns the number of rows inserted by this call
+    def load(self, shards, build_index=True):
+        rows = 0
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            for shard in shards:
+                if self.state.get(shard, {}).get("status") == "committed":
+                    continue
+                rows += self.load_shard(pool, shard)
+                sys.stderr.write("\r{} rows loaded".format(rows))
+        if build_index and self.collection_name in self.client.list_collections():
+            self.client.create_index(self.collection_name, self.field, self.index_params)
+        return rows
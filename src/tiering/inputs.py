@@ -0,0 +1,102 @@
+import os
+import sys
+import shutil
+import subprocess
+
+
+# input codecs by file extension; anything else is read as plain text
+INPUT_CODECS = {'.gz': 'gzip', '.zst': 'zstd', '.xz': 'xz', '.7z': '7z'}
+NON_ASCII = bytes(range(128, 256))
+
+
+def input_codec(path):
+    return INPUT_CODECS.get(os.path.splitext(path)[1].lower(), 'none')
+
+
+# stdout of a decompressor process as a binary input; close() checks its exit status
+class ProcessInput:
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.proc = subprocess.Popen(argv, stdout=subprocess.PIPE, bufsize=1 << 22)
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.wait() not in (0, -13):  # -13: SIGPIPE after we stopped reading early
+            raise IOError("{} exited with status {}".format(" ".join(self.argv), self.proc.returncode))
+
+
+# open an input file as a binary stream of its decompressed bytes ("-" is stdin)
+#   gzip:  python-isal's threaded reader if installed (decompression in its own thread), else gzip
+#   zstd:  zstandard (frames decode sequentially)
+#   xz:    `xz -T threads`, which decompresses multi-block files in parallel, else lzma
+#   7z:    `7z e -so -mmt=threads` (no streaming 7z reader exists for python)
+# gzip/zstd/lzma streams can seek forward (by decompressing), so resume does not parse skipped lines
+def open_input(path, threads=4):
+    if path == "-":
+        return sys.stdin.buffer
+    codec = input_codec(path)
+    if codec == 'gzip':
+        try:
+            from isal import igzip_threaded
+            return igzip_threaded.open(path, "rb", threads=threads)
+        except ImportError:
+            import gzip
+            return gzip.open(path, "rb")
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.open(path, "rb")
+    if codec == 'xz':
+        if shutil.which("xz"):
+            return ProcessInput(["xz", "-dc", "-T", str(threads), path])
+        import lzma
+        return lzma.open(path, "rb")
+    if codec == '7z':
+        program = shutil.which("7z") or shutil.which("7za")
+        if program is None:
+            raise ValueError("reading {} needs the 7z program".format(path))
+        return ProcessInput([program, "e", "-so", "-bd", "-mmt={}".format(threads), path])
+    return open(path, "rb")
+
+
+# lines of a binary input as (raw length, line), read in chunks of chunk_bytes
+#   lines are sliced out of each chunk at its newlines (memchr, no per-byte work in python); with
+#   ascii_only the bytes above 127 are deleted, by one translate of the lines that are not pure ASCII (what
+#   `tr -dc '\0-\177'` did in a separate process); raw lengths count the bytes before filtering, so offsets
+#   summed from them are positions in the (decompressed) input
+def read_lines(f, ascii_only=False, chunk_bytes=1 << 22):
+    rest = b""
+    while True:
+        chunk = f.read(chunk_bytes)
+        if not chunk:
+            break
+        if rest:
+            chunk = rest + chunk
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start) + 1
+            if end == 0:
+                break
+            line = chunk[start:end]
+            if ascii_only and not line.isascii():
+                line = line.translate(None, NON_ASCII)
+            yield end - start, line
+            start = end
+        rest = chunk[start:]
+    if rest:
+        yield len(rest), rest.translate(None, NON_ASCII) if ascii_only else rest
+
+
+# read and drop the first size bytes of a stream that cannot seek
+def discard(f, size, chunk_bytes=1 << 24):
+    while size > 0:
+        data = f.read(min(size, chunk_bytes))
+        if not data:
+            break
+        size -= len(data)
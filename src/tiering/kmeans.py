@@ -0,0 +1,37 @@
+import numpy as np
+
+
+# squared L2 distances between the rows of x and the centroids, as one matmul
+def sq_distances(x, centroids):
+    return (np.einsum('ij,ij->i', x, x)[:, None] - 2 * x @ centroids.T
+            + np.einsum('ij,ij->i', centroids, centroids)[None, :])
+
+
+def assign(x, centroids):
+    return np.argmin(sq_distances(x, centroids), axis=1)
+
+
+# per-cluster sums and counts of x, by sorting on the labels and one np.add.reduceat
+def cluster_sums(x, labels, k):
+    counts = np.bincount(labels, minlength=k)
+    sums = np.zeros(shape=[k, x.shape[1]], dtype=np.float64)
+    order = np.argsort(labels, kind='stable')
+    present = np.flatnonzero(counts)
+    starts = np.concatenate([[0], np.cumsum(counts[present])[:-1]])
+    sums[present] = np.add.reduceat(x[order], starts, axis=0)
+    return sums, counts
+
+
+# Lloyd's k-means; empty clusters are re-seeded from random points
+def kmeans(x, k, iters=20, seed=0):
+    x = np.asarray(x, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        sums, counts = cluster_sums(x, assign(x, centroids), k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        if not filled.all():
+            centroids[~filled] = x[rng.choice(len(x), int((~filled).sum()))]
+    return centroids
@@ -0,0 +1,86 @@
+import sys
+import json
+from time import perf_counter, time
+
+
+# wall-clock seconds per stage of an embedding run
+#   read:     input lines (decode, doclist/lastdoc filters)
+#   parse:    json body extraction
+#   clean:    character/space normalization
+#   split:    segmentation (includes tokenization with --segment_tokens)
+#   tokenize: vectorizer tokenization/padding
+#   encode:   model forward pass and per-segment pooling (on GPU this also absorbs the device sync)
+#   pool:     per-document mean of the segment vectors
+#   write:    cleantext and vector shards
+# in --pipeline mode parse/clean/split are summed over the cleaning processes, so they can exceed elapsed
+STAGES = ['read', 'parse', 'clean', 'split', 'tokenize', 'encode', 'pool', 'write']
+RATES = ['lines', 'documents', 'segments', 'tokens']
+
+
+# stage timers, counters and gauges of one run; a JSON line is emitted at most every interval seconds
+# and a summary at the end. Runs without --metrics have no Metrics object at all (callers check for None)
+class Metrics:
+
+    def __init__(self, path, interval=30.0):
+        self.f = sys.stderr if path == "-" else open(path, "a", encoding="utf8")
+        self.interval = interval
+        self.start = perf_counter()
+        self.last = self.start
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.counts = dict.fromkeys(RATES, 0)
+        self.gauges = {}
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    # add per-stage seconds measured elsewhere (e.g. returned by a cleaning process)
+    def merge(self, seconds):
+        for stage, value in seconds.items():
+            self.seconds[stage] += value
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    # counters kept as running totals by someone else (input lines, PaddingStats tokens)
+    def total(self, name, value):
+        self.counts[name] = value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self, event="progress"):
+        elapsed = perf_counter() - self.start
+        record = {'event': event, 'time': round(time(), 3), 'elapsed': round(elapsed, 3),
+                  'seconds': {stage: round(value, 3) for stage, value in self.seconds.items()},
+                  'counts': dict(self.counts)}
+        record['rates'] = {name + "/sec": round(self.counts.get(name, 0) / elapsed, 1) if elapsed else 0.0
+                           for name in RATES}
+        padded = self.counts.get('padded', 0)
+        record['padding'] = round(1.0 - self.counts['tokens'] / padded, 4) if padded else None
+        record.update(self.gauges)
+        return record
+
+    def emit(self, event="progress"):
+        record = self.snapshot(event)
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        return record
+
+    # emit if the interval has passed; cheap enough to call once per batch
+    def tick(self):
+        now = perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.emit()
+
+    # final JSON record plus a human-readable stage breakdown on stderr
+    def close(self):
+        record = self.emit("summary")
+        elapsed = record['elapsed'] or 1.0
+        sys.stderr.write("\nstage\tseconds\t% of wall\n")
+        for stage in STAGES:
+            sys.stderr.write("%s\t%0.2f\t%0.1f\n" % (stage, self.seconds[stage], 100 * self.seconds[stage] / elapsed))
+        sys.stderr.write(" ".join("%s %0.1f" % (name, value) for name, value in record['rates'].items()) + "\n")
+        if self.f is not sys.stderr:
+            self.f.close()
+        return record
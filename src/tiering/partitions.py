@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from time import monotonic
+
+from .checkpoint import Manifest
+from .inputs import input_codec
+
+
+# split a file into n byte ranges [start, end), each boundary moved forward to the next line start
+def partition_ranges(path, n):
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, n):
+            f.seek(max(size * i // n, bounds[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()  # finish the line we landed in (a no-op if we are at a line start)
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def partition_output(output, idx):
+    return "{}.part{}".format(output, idx)
+
+
+# pin the math libraries of this process to a fixed number of threads
+#   (must run before the model is loaded; OMP_NUM_THREADS only takes effect if set before the import)
+def set_threads(threads, t5):
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    if t5:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    else:
+        import torch
+        torch.set_num_threads(threads)
+
+
+# worker process: one Embeddings over one byte range, with its own vectorizer and output prefix
+def run_partition(options, idx, start, end):
+    args = argparse.Namespace(**options)
+    args.output = partition_output(options['output'], idx)
+    if args.metrics and args.metrics != "-":
+        args.metrics = partition_output(options['metrics'], idx)
+    # the cache index lives in each process, so processes cannot share one cache's slots
+    if args.cache:
+        args.cache = partition_output(options['cache'], idx)
+    if args.threads_per_worker:
+        set_threads(args.threads_per_worker, args.t5)
+    from .embeddings import Embeddings
+    return Embeddings(args, byte_range=(start, end)).run()
+
+
+# process one input file in args.partitions worker processes and merge their manifests
+def run_partitions(args):
+    if args.input == "-" or input_codec(args.input) != 'none':
+        raise ValueError("partitioned runs need a seekable, uncompressed input file")
+    start = monotonic()
+    ranges = partition_ranges(args.input, args.partitions)
+    options = vars(args)
+    if not args.threads_per_worker:
+        options = dict(options, threads_per_worker=max(1, (os.cpu_count() or 1) // len(ranges)))
+    sys.stderr.write("Processing {} in {} partitions\n".format(args.input, len(ranges)))
+    # TF and torch are not fork-safe; each worker starts clean and loads its own model
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=context) as pool:
+        futures = [pool.submit(run_partition, options, idx, s, e) for idx, (s, e) in enumerate(ranges)]
+        for future in futures:
+            future.result()
+
+    partitions = []
+    for idx, (s, e) in enumerate(ranges):
+        output = partition_output(args.output, idx)
+        partitions.append({'partition': idx, 'start': s, 'end': e, 'output': output,
+                           'shards': Manifest(output + ".manifest.jsonl").entries()})
+    with open(args.output + ".partitions.json", "w") as f:
+        json.dump({'input': args.input, 'partitions': partitions}, f, indent=1)
+    return (monotonic() - start) / 60
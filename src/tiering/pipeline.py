@@ -0,0 +1,154 @@
+import sys
+import threading
+import multiprocessing
+from queue import Queue
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from .cleantext import clean_records
+
+
+# end-of-stream marker for the stage queues
+_DONE = None
+
+
+# clean_records in a worker process, returning its parse/clean/split seconds with the result (--metrics)
+def timed_clean_records(*args):
+    timings = {'parse': 0.0, 'clean': 0.0, 'split': 0.0}
+    return clean_records(*args, timings=timings), timings
+
+
+# pipelined version of Embeddings.run:
+#   feeder thread:  read + filter lines, hand chunks of lines to a process pool for cleaning/splitting
+#   main thread:    collect cleaned chunks in input order, assemble segment batches, encode
+#   writer thread:  cleantext rows, vector shards, file rotation
+# stages are joined by bounded queues, so at most queue_depth cleaned chunks and
+# 2 encoded batches are held in memory at any time
+class Pipeline:
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.cleaner = embeddings.cleaner
+        self.args = embeddings.args
+        self.chunk_lines = self.args.clean_chunk_lines
+        self.clean_workers = self.args.clean_workers
+        # enough cleaned chunks in flight that the encoder never waits for input
+        depth = self.args.queue_depth or 2 * self.clean_workers
+        self.clean_q = Queue(maxsize=depth)
+        self.write_q = Queue(maxsize=2)
+        self.errors = []
+        self.metrics = embeddings.metrics
+
+    # feeder stage: the futures are queued in submission order, which keeps the output in input order
+    def feed(self, pool):
+        try:
+            records, positions = [], []
+            lines = self.cleaner.next_line()
+            while not self.errors:
+                t0 = perf_counter()
+                record = next(lines, None)
+                if self.metrics is not None:
+                    self.metrics.add('read', perf_counter() - t0)
+                if record is None:
+                    break
+                records.append(record)
+                positions.append((self.cleaner.totlines, self.cleaner.offset))
+                if len(records) >= self.chunk_lines:
+                    self.submit(pool, records, positions)
+                    records, positions = [], []
+            if records:
+                self.submit(pool, records, positions)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.clean_q.put(_DONE)
+
+    # positions: (lines, offset) of the input right after each record, for checkpoints
+    def submit(self, pool, records, positions):
+        fn = clean_records if self.metrics is None else timed_clean_records
+        future = pool.submit(fn, records, self.cleaner.max_words, self.args.truncate,
+                             self.cleaner.is_json, self.cleaner.token_model, self.args.max_segment_tokens,
+                             self.args.segment_overlap)
+        self.clean_q.put((future, positions))
+
+    # writer stage: after a failure keep draining the queue so the encoder never blocks on it
+    def write(self):
+        while True:
+            item = self.write_q.get()
+            if item is _DONE:
+                return
+            if self.errors:
+                continue
+            try:
+                self.embeddings.write(*item)
+            except Exception as e:
+                self.errors.append(e)
+
+    def encode(self, segments, batch, documents, groups, input_ids, position):
+        self.write_q.put(self.embeddings.prepare(segments, batch, documents, groups, input_ids, position))
+
+    def run(self):
+        start = perf_counter()
+        segments, batch, documents, groups = [], [], [], []
+        input_ids = [] if self.cleaner.token_model else None
+        records = 0
+        writer = threading.Thread(target=self.write, name="writer", daemon=True)
+        writer.start()
+        # the encoder model (and its threads) is already loaded here, which fork does not copy safely
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.clean_workers, mp_context=context) as pool:
+            feeder = threading.Thread(target=self.feed, args=(pool,), name="feeder", daemon=True)
+            feeder.start()
+            done = False
+            while not done and not self.errors:
+                item = self.clean_q.get()
+                done = item is _DONE
+                if done:
+                    break
+                future, positions = item
+                try:
+                    cleaned = future.result()
+                except Exception as e:
+                    self.errors.append(e)
+                    break
+                if self.metrics is not None:
+                    cleaned, timings = cleaned
+                    self.metrics.merge(timings)
+                docids, sections, counts, ids = cleaned
+                offset = 0
+                for docid, count, position in zip(docids, counts, positions):
+                    records += 1
+                    documents.append(docid)
+                    groups.append(count)
+                    for idx in range(count):
+                        segments.append(docid + "." + str(idx))
+                    batch.extend(sections[offset:offset + count])
+                    if ids is not None:
+                        input_ids.extend(ids[offset:offset + count])
+                    offset += count
+                    # only break batches on document boundaries
+                    if len(segments) > self.embeddings.segment_batch_size:
+                        self.encode(segments, batch, documents, groups, input_ids, position)
+                        segments, batch, documents, groups = [], [], [], []
+                        input_ids = [] if self.cleaner.token_model else None
+                        # input lines up to the batch just encoded (the feeder's totlines runs ahead)
+                        if self.args.verbose:
+                            sys.stderr.write("\r%d (%d) [clean queue %d, write queue %d]" %
+                                             (position[0], records, self.clean_q.qsize(),
+                                              self.write_q.qsize()))
+                            sys.stderr.write(self.embeddings.stats())
+                        else:
+                            sys.stderr.write("\r%d (%d)" % (position[0], records))
+                        self.embeddings.observe(clean_queue=self.clean_q.qsize(), write_queue=self.write_q.qsize())
+            if segments and not self.errors:
+                self.encode(segments, batch, documents, groups, input_ids, position)
+            # unblock the feeder if we stopped early
+            while not done:
+                done = self.clean_q.get() is _DONE
+            feeder.join()
+        self.write_q.put(_DONE)
+        writer.join()
+        if self.errors:
+            raise self.errors[0]
+        self.embeddings.close()
+        return (perf_counter() - start) / 60
@@ -0,0 +1,151 @@
+import numpy as np
+
+from .kmeans import kmeans, assign
+
+
+# storage codecs for embedding shards (see shards.py); each maps float32 rows to stored codes and back
+#   trained:      False until fit() has seen a sample (the shard writer buffers rows until then)
+#   state():      JSON-able parameters kept in the shard header; save()/load() for larger ones
+CODECS = ['float32', 'float16', 'bfloat16', 'int8', 'pq']
+
+
+class FloatCodec:
+
+    def __init__(self, name):
+        self.name = name
+        self.storage = np.dtype(name)
+        self.trained = True
+
+    def width(self, dim):
+        return dim
+
+    def fit(self, sample):
+        pass
+
+    def encode(self, x):
+        return np.ascontiguousarray(x, dtype=self.storage)
+
+    def decode(self, codes):
+        return np.asarray(codes, dtype=np.float32)
+
+    def state(self):
+        return {}
+
+    def save(self, name):
+        pass
+
+
+# bfloat16 kept as uint16: the high half of the float32 bits, rounded to nearest even
+class BFloat16Codec(FloatCodec):
+
+    def __init__(self, name='bfloat16'):
+        super().__init__('uint16')
+        self.name = name
+
+    def encode(self, x):
+        bits = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32)
+        rounding = np.uint32(0x7fff) + ((bits >> 16) & np.uint32(1))
+        return ((bits + rounding) >> 16).astype(np.uint16)
+
+    def decode(self, codes):
+        return (np.asarray(codes, dtype=np.uint32) << 16).view(np.float32)
+
+
+# per-dimension affine int8: code = round((x - offset) / scale) - 128, fitted on the first rows of a shard;
+# later values outside the fitted range are clipped
+class Int8Codec(FloatCodec):
+
+    def __init__(self, name='int8', scale=None, offset=None):
+        super().__init__('int8')
+        self.name = name
+        self.scale = None if scale is None else np.asarray(scale, dtype=np.float32)
+        self.offset = None if offset is None else np.asarray(offset, dtype=np.float32)
+        self.trained = scale is not None
+
+    def fit(self, sample):
+        low = sample.min(axis=0)
+        high = sample.max(axis=0)
+        self.offset = low.astype(np.float32)
+        self.scale = np.maximum((high - low) / 255.0, 1e-12).astype(np.float32)
+        self.trained = True
+
+    def encode(self, x):
+        codes = np.rint((np.asarray(x, dtype=np.float32) - self.offset) / self.scale) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def decode(self, codes):
+        return (np.asarray(codes, dtype=np.float32) + 128) * self.scale + self.offset
+
+    def state(self):
+        return {'scale': self.scale.tolist(), 'offset': self.offset.tolist()}
+
+
+# product quantization: m sub-vectors, each coded by the nearest of 256 k-means centroids (one byte)
+#   the codebook is trained once (on the first rows of the first shard) and reused for later shards
+class PQCodec(FloatCodec):
+
+    def __init__(self, name='pq', m=96, codebook=None):
+        super().__init__('uint8')
+        self.name = name
+        self.m = m
+        self.codebook = codebook
+        self.trained = codebook is not None
+
+    def width(self, dim):
+        return self.m
+
+    def fit(self, sample):
+        sample = np.asarray(sample, dtype=np.float32)
+        sub = np.split(sample, self.m, axis=1)
+        self.codebook = np.stack([kmeans(part, 256, seed=idx) for idx, part in enumerate(sub)])
+        self.trained = True
+
+    def encode(self, x):
+        sub = np.split(np.asarray(x, dtype=np.float32), self.m, axis=1)
+        return np.stack([assign(part, self.codebook[idx]) for idx, part in enumerate(sub)], axis=1).astype(np.uint8)
+
+    def decode(self, codes):
+        codes = np.asarray(codes)
+        return np.concatenate([self.codebook[idx][codes[:, idx]] for idx in range(self.m)], axis=1)
+
+    def state(self):
+        return {'m': self.m}
+
+    def save(self, name):
+        np.save(name + ".codebook.npy", self.codebook)
+
+
+def make_codec(name, pq_m=96):
+    if name == 'bfloat16':
+        return BFloat16Codec()
+    if name == 'int8':
+        return Int8Codec()
+    if name == 'pq':
+        return PQCodec(m=pq_m)
+    return FloatCodec(name)
+
+
+# codec of a written shard, from its header
+def load_codec(name, header):
+    dtype = header['dtype']
+    if dtype == 'bfloat16':
+        return BFloat16Codec()
+    if dtype == 'int8':
+        return Int8Codec(scale=header['scale'], offset=header['offset'])
+    if dtype == 'pq':
+        return PQCodec(m=header['m'], codebook=np.load(name + ".codebook.npy"))
+    return FloatCodec(dtype)
+
+
+# fraction of the exact top-k neighbours (cosine on float32) that the decoded vectors also return
+def recall_at_k(reference, decoded, queries, k=10):
+    def normalize(x):
+        return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+    reference = normalize(np.asarray(reference, dtype=np.float32))
+    decoded = normalize(np.asarray(decoded, dtype=np.float32))
+    q = reference[queries]
+    exact = np.argpartition(-(q @ reference.T), k, axis=1)[:, :k]
+    approx = np.argpartition(-(q @ decoded.T), k, axis=1)[:, :k]
+    hits = sum(len(np.intersect1d(e, a)) for e, a in zip(exact, approx))
+    return hits / (len(queries) * k)
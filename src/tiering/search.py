@@ -0,0 +1,172 @@
+import json
+from bisect import bisect_right
+import numpy as np
+
+from .shards import ShardReader
+from .kmeans import kmeans, assign
+
+
+# nearest-neighbour search over embedding shards (shards.py), without a vector database
+#   metric 'cosine' returns similarities (higher is better), 'l2' squared distances (lower is better);
+#   results are global row numbers over the shards in the order given, see ShardSet.docid
+METRICS = ['cosine', 'l2']
+
+
+def normalize(x):
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+# the shards as one row space; rows are read through the memmaps a block at a time
+class ShardSet:
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.readers = [ShardReader(name) for name in self.names]
+        self.offsets = np.concatenate([[0], np.cumsum([r.rows for r in self.readers])]).astype(np.int64)
+        self.rows = int(self.offsets[-1])
+        self.dim = self.readers[0].dim if self.readers else 0
+
+    # float32 rows [start, end) of every shard, in blocks of at most block_rows
+    def blocks(self, block_rows):
+        for reader, base in zip(self.readers, self.offsets):
+            for start in range(0, reader.rows, block_rows):
+                end = min(start + block_rows, reader.rows)
+                yield int(base) + start, np.asarray(reader[start:end], dtype=np.float32)
+
+    # float32 copies of the given rows (sorted global row numbers), gathered in one pass over the blocks
+    def take(self, rows, block_rows=65536):
+        out = np.empty((len(rows), self.dim), dtype=np.float32)
+        for start, vectors in self.blocks(block_rows):
+            lo, hi = np.searchsorted(rows, [start, start + len(vectors)])
+            out[lo:hi] = vectors[rows[lo:hi] - start]
+        return out
+
+    def docid(self, row):
+        shard = bisect_right(self.offsets, row) - 1
+        return self.readers[shard].docids[row - self.offsets[shard]]
+
+
+# (scores, rows) of the k best scores per query row, best first; scores are "higher is better"
+def top_k(scores, rows, k):
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-best, axis=1, kind='stable')
+    return np.take_along_axis(best, order, axis=1), np.take_along_axis(rows, np.take_along_axis(part, order, axis=1), axis=1)
+
+
+# scores of queries against a block of vectors, as one matmul ("higher is better": negated distance for l2)
+def block_scores(queries, vectors, metric):
+    if metric == 'cosine':
+        return queries @ normalize(vectors).T
+    return 2 * queries @ vectors.T - np.einsum('ij,ij->i', vectors, vectors)[None, :] \
+        - np.einsum('ij,ij->i', queries, queries)[:, None]
+
+
+def finish(scores, metric):
+    return scores if metric == 'cosine' else -scores
+
+
+# exact search: blocked matmul over every shard, keeping a running top-k per query
+class ExactSearch:
+
+    def __init__(self, shards, metric='cosine', block_rows=65536):
+        self.shards = shards
+        self.metric = metric
+        self.block_rows = block_rows
+
+    def search(self, queries, k=10):
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.metric == 'cosine':
+            queries = normalize(queries)
+        best = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start, vectors in self.shards.blocks(self.block_rows):
+            scores = block_scores(queries, vectors, self.metric)
+            rows = np.broadcast_to(np.arange(start, start + len(vectors), dtype=np.int64), scores.shape)
+            best, best_rows = top_k(np.concatenate([best, scores], axis=1),
+                                    np.concatenate([best_rows, rows], axis=1), k)
+        return finish(best, self.metric), best_rows
+
+
+# IVF index: k-means coarse quantizer + inverted lists
+#   the vectors are copied in list order (normalized for cosine), so probing a list is one contiguous read;
+#   persisted as <path>.json, <path>.centroids.npy, <path>.offsets.npy, <path>.rows.npy, <path>.vectors.npy
+class IVFIndex:
+
+    def __init__(self, path, metric, centroids, offsets, rows, vectors, shards=None):
+        self.path = path
+        self.metric = metric
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+        self.vectors = vectors
+        self.shards = shards
+
+    @classmethod
+    def build(cls, path, shards, nlist=1024, metric='cosine', sample=100000, iters=20, block_rows=65536, seed=0):
+        rng = np.random.default_rng(seed)
+        picks = np.sort(rng.choice(shards.rows, min(sample, shards.rows), replace=False))
+        train = shards.take(picks, block_rows)
+        labels = np.empty(shards.rows, dtype=np.int64)
+        if metric == 'cosine':
+            train = normalize(train)
+        centroids = kmeans(train, nlist, iters=iters, seed=seed)
+        for start, vectors in shards.blocks(block_rows):
+            if metric == 'cosine':
+                vectors = normalize(vectors)
+            labels[start:start + len(vectors)] = assign(vectors, centroids)
+
+        rows = np.argsort(labels, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=len(centroids)))]).astype(np.int64)
+        out = np.lib.format.open_memmap(path + ".vectors.npy", mode='w+', dtype=np.float32,
+                                        shape=(shards.rows, shards.dim))
+        # rows[i] is the global row stored at list position i; fill the copy one source block at a time
+        position = np.empty_like(rows)
+        position[rows] = np.arange(len(rows))
+        for start, vectors in shards.blocks(block_rows):
+            if metric == 'cosine':
+                vectors = normalize(vectors)
+            out[position[start:start + len(vectors)]] = vectors
+        out.flush()
+        np.save(path + ".centroids.npy", centroids)
+        np.save(path + ".offsets.npy", offsets)
+        np.save(path + ".rows.npy", rows)
+        with open(path + ".json", "w") as f:
+            json.dump({'metric': metric, 'nlist': len(centroids), 'shards': shards.names}, f)
+        return cls(path, metric, centroids, offsets, rows, out, shards)
+
+    @classmethod
+    def load(cls, path):
+        with open(path + ".json", "r") as f:
+            header = json.load(f)
+        return cls(path, header['metric'], np.load(path + ".centroids.npy"), np.load(path + ".offsets.npy"),
+                   np.load(path + ".rows.npy"), np.load(path + ".vectors.npy", mmap_mode='r'),
+                   ShardSet(header['shards']))
+
+    def search(self, queries, k=10, nprobe=8):
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.metric == 'cosine':
+            queries = normalize(queries)
+        probes = top_k(block_scores(queries, self.centroids, self.metric),
+                       np.broadcast_to(np.arange(len(self.centroids)), (len(queries), len(self.centroids))),
+                       nprobe)[1]
+        # one matmul per probed list against all the queries probing it, merged into their running top-k
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        for l in np.unique(probes):
+            start, end = self.offsets[l], self.offsets[l + 1]
+            if start == end:
+                continue
+            qs = np.flatnonzero((probes == l).any(axis=1))
+            s = block_scores(queries[qs], np.asarray(self.vectors[start:end]), self.metric)
+            r = np.broadcast_to(self.rows[start:end], s.shape)
+            scores[qs], rows[qs] = top_k(np.concatenate([scores[qs], s], axis=1),
+                                         np.concatenate([rows[qs], r], axis=1), k)
+        return finish(scores, self.metric), rows
+
+
+# fraction of the exact top-k rows that an approximate search also returned
+def recall(exact_rows, approx_rows):
+    k = exact_rows.shape[1]
+    return sum(len(np.intersect1d(e, a)) for e, a in zip(exact_rows, approx_rows)) / (len(exact_rows) * k)
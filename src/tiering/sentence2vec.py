@@ -1,14 +1,85 @@
+from time import perf_counter
+import numpy as np
 from sentence_transformers import SentenceTransformer
 
+from .document_processor import group_mean
+from .batching import PaddingStats, encode_bucketed
+
 
 class Sentence2Vec():
 
     # if device=None, let system pick (GPU first)
-    def __init__(self, modelpath, device=None, batch_size=32, num_workers=1):
+    # max_tokens > 0 batches segments by token budget (see batching.py) instead of batch_size rows
+    # processes > 0 encodes on CPU in that many worker processes of threads torch threads each
+    #   (see encoder_pool.py); this process keeps its own copy of the model for tokenization
+    def __init__(self, modelpath, device=None, batch_size=32, num_workers=1, max_tokens=0, processes=0, threads=0):
         self.model = SentenceTransformer(modelpath, device=device)
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.batch = 0
+        self.max_tokens = max_tokens
+        self.padding = PaddingStats()
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.metrics = None  # stage timers (see metrics.py), set by Embeddings with --metrics
+        self.controller = None  # adaptive token budget (see autobatch.py), set by Embeddings with --memory_limit
+        self.pool = None
+        if processes:
+            from .encoder_pool import EncoderPool
+            self.pool = EncoderPool(modelpath, self.dim, processes, threads, max_rows=max(4096, batch_size))
+
+    # token lengths as the model will see them (truncated to max_seq_length)
+    def lengths(self, batch):
+        input_ids = self.model.tokenizer(batch, add_special_tokens=True)['input_ids']
+        return [min(len(ids), self.model.max_seq_length) for ids in input_ids]
+
+    # SentenceTransformer.encode, timed as the 'encode' stage when metrics are on
+    #   (it tokenizes the text itself, so its tokenization is part of that stage)
+    def encode(self, batch, batch_size):
+        t0 = perf_counter()
+        if self.pool is not None:
+            embeddings = self.pool.encode(batch, batch_size)
+        else:
+            embeddings = self.model.encode(batch, batch_size, num_workers=self.num_workers)
+        if self.metrics is not None:
+            self.metrics.add('encode', perf_counter() - t0)
+        return embeddings
+
+    # padding of the batches SentenceTransformer.encode forms itself: it sorts the texts by length (in
+    #   characters, longest first) and cuts batch_size rows at a time, padding each to its longest member
+    def count_padding(self, batch):
+        t0 = perf_counter()
+        lengths = np.asarray(self.lengths(batch))
+        order = np.argsort([-len(text) for text in batch], kind='stable')
+        for start in range(0, len(order), self.batch_size):
+            self.padding.add(lengths[order[start:start + self.batch_size]])
+        self.metrics.add('tokenize', perf_counter() - t0)
+
+    def bucketed_embeddings(self, batch):
+        def encode(idx):
+            return self.encode([batch[i] for i in idx], len(idx))
+
+        t0 = perf_counter()
+        lengths = self.lengths(batch)
+        if self.metrics is not None:
+            self.metrics.add('tokenize', perf_counter() - t0)
+        # the controller sizes the batches by memory, not by a row count
+        max_batch = self.batch_size if self.controller is None else 0
+        return encode_bucketed(encode, lengths, self.max_tokens, max_batch, self.dim, self.padding, self.controller)
 
-    def get_embeddings(self, batch, groups=None):
-        return self.model.encode(batch, self.batch_size, num_workers=self.num_workers)
+    # segment embeddings, mean-pooled per document when groups are given (same contract as T5Processor)
+    #   input_ids is accepted for compatibility; SentenceTransformer always tokenizes the text itself
+    def get_embeddings(self, batch, groups=None, input_ids=None):
+        if self.max_tokens or self.controller is not None:
+            embeddings = self.bucketed_embeddings(batch)
+        else:
+            # the token counts cost a second tokenization, so they are only kept for --metrics
+            if self.metrics is not None:
+                self.count_padding(batch)
+            embeddings = self.encode(batch, self.batch_size)
+        if groups is None:
+            return embeddings
+        t0 = perf_counter()
+        embeddings = group_mean(embeddings, groups)
+        if self.metrics is not None:
+            self.metrics.add('pool', perf_counter() - t0)
+        return embeddings
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import stat
+import shlex
+import socket
+
+
+# long-lived encoder worker: one vectorizer stays loaded and runs generate-embeddings jobs one at a time
+#   request:   one line per job, either JSON {"argv": [generate-embeddings.py arguments], "cwd": "..."}
+#              or the arguments as a shell-quoted string; {"shutdown": true} stops the server
+#   response:  one JSON line, {"ok": true, "minutes": ...} or {"ok": false, "error": "..."}
+#   transport: a Unix stream socket (any number of requests per connection), or stdin/stdout ('-')
+# this module only imports the model backend once a server starts, so clients stay light
+
+def decode_request(line):
+    line = line.strip()
+    if line.startswith("{"):
+        return json.loads(line)
+    return {'argv': shlex.split(line)}
+
+
+class EncoderServer:
+
+    # parser: generate-embeddings.py's parser; check(args) returns an error message for invalid jobs
+    def __init__(self, parser, args, check):
+        from .embeddings import make_vectorizer
+        self.parser = parser
+        self.args = args
+        self.check = check
+        self.vectorizer = make_vectorizer(args)
+        self.jobs = 0
+        sys.stderr.write("Encoder loaded: {}\n".format(args.model))
+
+    def mismatch(self, job):
+        from .embeddings import VECTORIZER_OPTIONS
+        return [name for name in VECTORIZER_OPTIONS if getattr(job, name) != getattr(self.args, name)]
+
+    def run(self, request):
+        from .embeddings import Embeddings
+        home = os.getcwd()
+        try:
+            if request.get('cwd'):
+                os.chdir(request['cwd'])
+            job = self.parser.parse_args(request['argv'])
+            error = self.check(job)
+            if error is None and job.embeddings and self.mismatch(job):
+                error = "job options differ from the server's: " + ", ".join(self.mismatch(job))
+            if error is None and (job.output == "-" or job.partitions > 1):
+                error = "served jobs need an --output prefix and a single partition"
+            if error is not None:
+                return {'ok': False, 'error': error}
+            minutes = Embeddings(job, vectorizer=self.vectorizer).run()
+            self.jobs += 1
+            return {'ok': True, 'minutes': minutes}
+        except (Exception, SystemExit) as e:
+            # argparse exits on bad arguments; the server must not
+            return {'ok': False, 'error': "{}: {}".format(type(e).__name__, e)}
+        finally:
+            os.chdir(home)
+
+    # answer requests from lines until shutdown or end of input; False if asked to shut down
+    def answer(self, lines, write):
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                request = decode_request(line)
+            except ValueError as e:
+                write({'ok': False, 'error': "bad request: {}".format(e)})
+                continue
+            if request.get('shutdown'):
+                write({'ok': True, 'jobs': self.jobs})
+                return False
+            write(self.run(request))
+        return True
+
+    def serve_stdio(self):
+        def write(response):
+            sys.stdout.write(json.dumps(response) + "\n")
+            sys.stdout.flush()
+
+        self.answer(sys.stdin, write)
+
+    def serve_socket(self, path):
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise ValueError("{} exists and is not a socket".format(path))
+            os.remove(path)  # stale socket of a previous server
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        sys.stderr.write("Serving on {}\n".format(path))
+        try:
+            running = True
+            while running:
+                conn, _ = server.accept()
+                with conn, conn.makefile("rw", encoding="utf8") as f:
+                    def write(response):
+                        f.write(json.dumps(response) + "\n")
+                        f.flush()
+
+                    running = self.answer(f, write)
+        finally:
+            server.close()
+            os.remove(path)
+
+    def serve(self, path):
+        if path == "-":
+            self.serve_stdio()
+        else:
+            self.serve_socket(path)
+
+
+# send one job to a server and wait for its response
+def submit(path, argv, cwd=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        with conn.makefile("rw", encoding="utf8") as f:
+            f.write(json.dumps({'argv': argv, 'cwd': cwd or os.getcwd()}) + "\n")
+            f.flush()
+            line = f.readline()
+    if not line:
+        return {'ok': False, 'error': "server closed the connection"}
+    return json.loads(line)
@@ -0,0 +1,264 @@
+import os
+import gzip
+import json
+import zlib
+import zipfile
+import numpy as np
+
+from .quantize import make_codec, load_codec
+
+
+# contiguous, memory-mappable embedding shards; a shard <name> is three files:
+#   <name>.vec   raw row-major matrix of stored codes, no header; whole batches are appended to it
+#   <name>.ids   one docid per line; line i is the docid of row i of .vec
+#   <name>.json  dtype/dim/width/rows header plus codec parameters, written on close
+#                (a shard without it is incomplete)
+# the stored codes are float32/float16 vectors or a quantization of them (see quantize.py)
+
+
+# model may be a local directory; only its last component goes into the name
+def shard_name(output, model, postfix):
+    return "{}.{}.embeddings.{}".format(output, os.path.basename(model.rstrip("/")), postfix)
+
+
+class ShardWriter:
+
+    # codec: a trained or untrained codec to share between shards (otherwise a new one for dtype);
+    # untrained codecs are fitted on the first train_rows rows, which are held back until then
+    def __init__(self, name, dtype='float32', codec=None, train_rows=10000):
+        self.name = name
+        self.codec = codec if codec is not None else make_codec(dtype)
+        self.train_rows = train_rows
+        self.dim = None
+        self.rows = 0
+        self.pending_ids = []
+        self.pending = []
+        self.vec_f = open(name + ".vec", "wb")
+        self.ids_f = open(name + ".ids", "w", encoding="utf8")
+
+    # append a batch of document vectors, one row per docid
+    def append(self, docids, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or len(docids) != embeddings.shape[0]:
+            raise ValueError("{} docids for embeddings of shape {}".format(len(docids), embeddings.shape))
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError("expected dimension {}, got {}".format(self.dim, embeddings.shape[1]))
+        if self.codec.trained:
+            self.write(docids, embeddings)
+            return
+        self.pending_ids.extend(docids)
+        self.pending.append(embeddings)
+        if len(self.pending_ids) >= self.train_rows:
+            self.train()
+
+    def train(self):
+        sample = np.concatenate(self.pending)
+        self.codec.fit(sample)
+        self.write(self.pending_ids, sample)
+        self.pending_ids = []
+        self.pending = []
+
+    def write(self, docids, embeddings):
+        self.vec_f.write(self.codec.encode(embeddings).tobytes())
+        self.ids_f.write("".join(docid + "\n" for docid in docids))
+        self.rows += len(docids)
+
+    def close(self):
+        if self.pending:
+            self.train()
+        self.vec_f.close()
+        self.ids_f.close()
+        header = {'dtype': self.codec.name, 'dim': self.dim or 0, 'rows': self.rows}
+        if self.codec.trained:
+            header['width'] = self.codec.width(self.dim or 0)
+            header.update(self.codec.state())
+            self.codec.save(self.name)
+        with open(self.name + ".json", "w") as f:
+            json.dump(header, f)
+
+
+class ShardReader:
+
+    def __init__(self, name):
+        self.name = name
+        with open(name + ".json", "r") as f:
+            header = json.load(f)
+        self.codec = load_codec(name, header) if header['rows'] else make_codec('float32')
+        self.dtype = self.codec.storage
+        self.dim = header['dim']
+        self.width = header.get('width', self.dim)
+        self.rows = header['rows']
+        if self.rows:
+            self.vectors = np.memmap(name + ".vec", dtype=self.dtype, mode='r', shape=(self.rows, self.width))
+        else:
+            # np.memmap refuses empty files
+            self.vectors = np.zeros((0, self.width), dtype=self.dtype)
+        self.quantized = self.codec.name not in ('float32', 'float16')
+        self._docids = None
+
+    @property
+    def docids(self):
+        if self._docids is None:
+            with open(self.name + ".ids", "r", encoding="utf8") as f:
+                self._docids = [line.rstrip("\n") for line in f]
+        return self._docids
+
+    def __len__(self):
+        return self.rows
+
+    # slices of a float memmap are views; nothing is read until the rows are touched
+    #   quantized shards return decoded float32 copies
+    def __getitem__(self, idx):
+        rows = self.vectors[idx]
+        if not self.quantized:
+            return rows
+        if rows.ndim == 1:
+            return self.codec.decode(rows[None, :])[0]
+        return self.codec.decode(rows)
+
+
+# convert a legacy .embeddings.N.npz shard (one headerless float32 "<docid>.npy" member per row)
+def convert_npz(path, name, dtype='float32', batch_size=10000):
+    writer = ShardWriter(name, dtype)
+    docids = []
+    rows = []
+    with zipfile.ZipFile(path, "r") as zf:
+        for info in zf.infolist():
+            docids.append(info.filename[:-4] if info.filename.endswith(".npy") else info.filename)
+            rows.append(np.frombuffer(zf.read(info), dtype=np.float32))
+            if len(rows) >= batch_size:
+                writer.append(docids, np.stack(rows))
+                docids.clear()
+                rows.clear()
+    if rows:
+        writer.append(docids, np.stack(rows))
+    writer.close()
+    return writer.rows
+
+
+# streaming compressed text shards (cleantext output); a shard <name> is two files:
+#   <name>.<format><ext>  rows in frames of about frame_bytes; every frame is a complete gzip member /
+#                         zstd frame, so the whole file is also a valid stream for zcat/zstdcat
+#   <name>.idx            segment \t frame offset \t row offset in the frame \t row length, one line per row
+# a row is read back by decompressing just its frame
+TEXT_FORMATS = ['tsv', 'jsonl']
+CODECS = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+
+def text_compressor(codec, level=None):
+    if codec == 'gzip':
+        return lambda data: gzip.compress(data, compresslevel=6 if level is None else level)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress
+    return lambda data: data
+
+
+def text_decompressor(codec):
+    if codec == 'gzip':
+        return zlib.decompressobj(wbits=31)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def text_shard_path(name, fmt, codec):
+    return name + "." + fmt + CODECS[codec]
+
+
+def format_row(fmt, segment, text):
+    if fmt == 'jsonl':
+        return json.dumps({'id': segment, 'text': text}) + "\n"
+    return "%s\t%s\n" % (segment, text)
+
+
+class TextShardWriter:
+
+    def __init__(self, name, fmt='tsv', codec='gzip', level=None, frame_bytes=1 << 20):
+        self.fmt = fmt
+        self.compress = text_compressor(codec, level)
+        self.frame_bytes = frame_bytes
+        self.f = open(text_shard_path(name, fmt, codec), "wb")
+        self.idx_f = open(name + ".idx", "w", encoding="utf8")
+        self.rows = []
+        self.index = []
+        self.size = 0
+
+    def write(self, segments, texts):
+        for segment, text in zip(segments, texts):
+            row = format_row(self.fmt, segment, text).encode("utf8")
+            self.index.append((segment, self.size, len(row)))
+            self.rows.append(row)
+            self.size += len(row)
+            if self.size >= self.frame_bytes:
+                self.flush_frame()
+
+    def flush_frame(self):
+        if not self.rows:
+            return
+        offset = self.f.tell()
+        self.f.write(self.compress(b"".join(self.rows)))
+        self.idx_f.write("".join("%s\t%d\t%d\t%d\n" % (segment, offset, start, length)
+                                 for segment, start, length in self.index))
+        self.rows.clear()
+        self.index.clear()
+        self.size = 0
+
+    def close(self):
+        self.flush_frame()
+        if self.f.tell() == 0:
+            # a shard without rows is still one (empty) gzip member / zstd frame, not a 0-byte file
+            self.f.write(self.compress(b""))
+        self.f.close()
+        self.idx_f.close()
+
+
+class TextShardReader:
+
+    def __init__(self, name, fmt='tsv', codec='gzip'):
+        self.fmt = fmt
+        self.codec = codec
+        self.f = open(text_shard_path(name, fmt, codec), "rb")
+        self.index = {}
+        with open(name + ".idx", "r", encoding="utf8") as f:
+            for line in f:
+                segment, frame, start, length = line.rstrip("\n").split("\t")
+                self.index[segment] = (int(frame), int(start), int(length))
+        self.frame = (None, b"")
+
+    # decompressed bytes of the frame starting at offset (the last frame is kept for sequential reads)
+    def read_frame(self, offset):
+        if self.frame[0] != offset:
+            self.f.seek(offset)
+            decompressor = text_decompressor(self.codec)
+            chunks = []
+            while not decompressor.eof:
+                data = self.f.read(1 << 16)
+                if not data:
+                    break
+                chunks.append(decompressor.decompress(data))
+            self.frame = (offset, b"".join(chunks))
+        return self.frame[1]
+
+    def read_row(self, frame, start, length):
+        if self.codec == 'none':
+            self.f.seek(frame + start)
+            return self.f.read(length)
+        return self.read_frame(frame)[start:start + length]
+
+    def __contains__(self, segment):
+        return segment in self.index
+
+    # text of one segment
+    def __getitem__(self, segment):
+        frame, start, length = self.index[segment]
+        row = self.read_row(frame, start, length).decode("utf8")
+        if self.fmt == 'jsonl':
+            return json.loads(row)['text']
+        return row.rstrip("\n").split("\t", 1)[1]
+
+    def close(self):
+        self.f.close()
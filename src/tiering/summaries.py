@@ -0,0 +1,98 @@
+import re
+import sqlite3
+import hashlib
+
+from .batching import plan_batches
+
+
+TASK = "summarize: "
+whitespace = re.compile(r'\s+')
+
+
+# persistent cache of document summaries in one sqlite file
+# keys hash (model, decoding options, document text), like EmbeddingCache, so changing the decoding
+# options never returns a summary made with other ones
+class SummaryCache:
+
+    def __init__(self, path, model, options):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS summaries (key BLOB PRIMARY KEY, summary TEXT)")
+        self.prefix = hashlib.blake2b("{}\0{}\0".format(model, options).encode("utf8"), digest_size=16)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        h = self.prefix.copy()
+        h.update(text.encode("utf8"))
+        return h.digest()
+
+    # summaries of the keys that are cached, as a dict
+    def get(self, keys):
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.db.execute("SELECT key, summary FROM summaries WHERE key IN ({})".format(
+                ",".join("?" * len(chunk))), chunk)
+            found.update(rows)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, keys, summaries):
+        self.db.executemany("INSERT OR REPLACE INTO summaries VALUES (?, ?)", zip(keys, summaries))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# batched T5 summaries of whole documents
+#   each distinct text is generated once per batch (and once ever with a cache); the rest are sorted by
+#   token length and generated in batches of up to batch_size rows and max_tokens input tokens, so rows
+#   of a batch need little padding; num_beams=1 is greedy decoding, max_length caps the decode steps
+#   model: the name the T5 model was loaded from, which keys the cache (TF models do not record it)
+class Summarizer:
+
+    def __init__(self, t5, num_beams=4, max_length=64, min_length=None, batch_size=16, max_tokens=0, cache=None,
+                 model=None):
+        self.t5 = t5
+        self.num_beams = num_beams
+        self.max_length = max_length
+        self.min_length = min_length
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.cache = None
+        if cache:
+            options = "beams={} max={} min={}".format(num_beams, max_length, min_length)
+            self.cache = SummaryCache(cache, model, options)
+
+    def generate(self, texts):
+        input_ids = self.t5.tokenizer([TASK + text for text in texts], truncation=True)['input_ids']
+        lengths = [len(ids) for ids in input_ids]
+        summaries = [None] * len(texts)
+        max_tokens = self.max_tokens or self.batch_size * max(lengths)
+        for idx in plan_batches(lengths, max_tokens, self.batch_size):
+            decoded = self.t5.summarize_ids([input_ids[i] for i in idx], self.max_length, self.min_length,
+                                            self.num_beams)
+            for i, text in zip(idx, decoded):
+                summaries[i] = whitespace.sub(' ', text).strip()
+        return summaries
+
+    # one summary per text, in order
+    def summarize(self, texts):
+        keys = [self.cache.key(text) for text in texts] if self.cache else list(texts)
+        found = self.cache.get(list(set(keys))) if self.cache else {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            generated = self.generate(list(missing.values()))
+            found.update(zip(missing.keys(), generated))
+            if self.cache:
+                self.cache.put(list(missing.keys()), generated)
+        return [found[key] for key in keys]
+
+    def close(self):
+        if self.cache:
+            self.cache.close()
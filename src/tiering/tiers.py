@@ -0,0 +1,113 @@
+import os
+import numpy as np
+
+from .kmeans import kmeans, sq_distances, cluster_sums
+from .search import normalize
+
+
+# streaming tier assignment of document vectors, batch by batch as they are written
+#   reference: fixed centroids (and optionally a tier per centroid) loaded from a file; vectors are only scored
+#   online:    mini-batch k-means; the first batch with at least k rows seeds the centroids by k-means (until
+#              then rows become centroids as they come), afterwards every centroid is the running mean of the
+#              vectors assigned to it (per-centroid learning rate 1/count), so early documents are assigned
+#              against earlier centroids
+#   each batch is one distance computation against all centroids; memory is the k centroids, not the corpus
+#   metric 'cosine' scores by similarity to the nearest centroid (spherical k-means, vectors normalized),
+#   'l2' by squared distance, as in search.py
+class Tiering:
+
+    def __init__(self, k=0, metric='cosine', centroids=None, tiers=None, counts=None, fixed=False):
+        self.k = k if centroids is None else len(centroids)
+        self.metric = metric
+        self.fixed = fixed
+        self.centroids = None if centroids is None else np.asarray(centroids, dtype=np.float64)
+        self.tiers = None if tiers is None else np.asarray(tiers, dtype=np.int32)
+        self.counts = np.zeros(self.k, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+    # reference centroids: a (k, dim) .npy, or an .npz with 'centroids' and optional 'tiers' (one per centroid)
+    # and 'counts' (as written by save)
+    @staticmethod
+    def load(path, metric='cosine', fixed=True):
+        if path.endswith(".npz"):
+            with np.load(path) as f:
+                return Tiering(metric=metric, centroids=f['centroids'], fixed=fixed,
+                               tiers=f['tiers'] if 'tiers' in f else None,
+                               counts=f['counts'] if 'counts' in f else None)
+        return Tiering(metric=metric, centroids=np.load(path), fixed=fixed)
+
+    def save(self, path):
+        if self.centroids is None:
+            return
+        arrays = {'centroids': self.centroids.astype(np.float32), 'counts': self.counts}
+        if self.tiers is not None:
+            arrays['tiers'] = self.tiers
+        # write and rename, so a crash never leaves a truncated model behind
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    # a copy of the online model as it is now, to save once the documents it has seen are checkpointed
+    def snapshot(self):
+        return Tiering(self.k, self.metric, None if self.centroids is None else self.centroids.copy(),
+                       self.tiers, self.counts.copy())
+
+    # seed the centroids from the stream: k-means over a batch with enough rows, else the rows themselves
+    def seed(self, x):
+        if self.centroids is None and len(x) >= self.k:
+            self.centroids = kmeans(x, self.k).astype(np.float64)
+            return
+        have = 0 if self.centroids is None else len(self.centroids)
+        rows = x[:self.k - have].astype(np.float64)
+        self.centroids = rows if self.centroids is None else np.concatenate([self.centroids, rows])
+
+    # (tier, score) of each row of a batch of document vectors, updating the centroids unless fixed
+    def assign(self, vectors):
+        x = np.asarray(vectors, dtype=np.float32)
+        if self.metric == 'cosine':
+            x = normalize(x)
+        if not self.fixed and (self.centroids is None or len(self.centroids) < self.k):
+            self.seed(x)
+        centroids = self.centroids.astype(np.float32)
+        if self.metric == 'cosine':
+            scores = x @ normalize(centroids).T
+            labels = np.argmax(scores, axis=1)
+        else:
+            scores = sq_distances(x, centroids)
+            labels = np.argmin(scores, axis=1)
+        scores = scores[np.arange(len(x)), labels]
+        if self.metric == 'l2':
+            scores = np.maximum(scores, 0.0)
+        if not self.fixed:
+            self.update(x, labels)
+        tiers = labels.astype(np.int32) if self.tiers is None else self.tiers[labels]
+        return tiers, scores.astype(np.float32)
+
+    # move each centroid to the running mean of every vector assigned to it so far
+    def update(self, x, labels):
+        k = len(self.centroids)
+        sums, counts = cluster_sums(x, labels, k)
+        self.counts[:k] += counts
+        hit = np.flatnonzero(counts)
+        self.centroids[hit] += (sums[hit] - counts[hit, None] * self.centroids[hit]) / self.counts[hit, None]
+
+
+# per-document tier and score columns of a vector shard <name>, row i for row i of <name>.vec:
+#   <name>.tier   int32
+#   <name>.score  float32
+class TierWriter:
+
+    def __init__(self, name):
+        self.tier_f = open(name + ".tier", "wb")
+        self.score_f = open(name + ".score", "wb")
+
+    def append(self, tiers, scores):
+        self.tier_f.write(np.asarray(tiers, dtype=np.int32).tobytes())
+        self.score_f.write(np.asarray(scores, dtype=np.float32).tobytes())
+
+    def close(self):
+        self.tier_f.close()
+        self.score_f.close()
+
+
+def read_tiers(name):
+    return np.fromfile(name + ".tier", dtype=np.int32), np.fromfile(name + ".score", dtype=np.float32)